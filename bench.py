@@ -0,0 +1,558 @@
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_FILE = os.path.join(PROJECT_DIR, "calpoly.db")
+
+
+def make_oracle(**kwargs):
+    from db import Database
+    from parse import Oracle
+    from entities.Club import ClubEnt
+    from entities.Professor import ProfessorEnt
+    from entities.Department import DepartmentEnt
+    from entities.Course import CourseEnt
+    from entities.Location import LocationEnt
+    from entities.Section import SectionEnt
+
+    db = Database(
+        f"sqlite:///{DB_FILE}",
+        {
+            ProfessorEnt: { "search_col": "alias", "name_remapping": "professors" },
+            ClubEnt: { "search_col": "name", "name_remapping": "clubs" },
+            DepartmentEnt: { "search_col": "name", "name_remapping": "departments" },
+            LocationEnt: { "search_col": "id", "name_remapping": "locations" },
+            CourseEnt: { "search_col": "title", "name_remapping": "courses" },
+            SectionEnt: { "search_col": "title", "name_remapping": "sections" }
+        }
+    )
+    return Oracle(db, **kwargs)
+
+
+def best_of(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def report(name, seconds):
+    print(f"{name:<48} {seconds * 1e6:12.1f} us")
+
+
+def bench_import(repeat=10):
+    # Each import runs in a fresh interpreter with the third-party and entity
+    # modules already loaded, so only parse.py itself is timed
+    script = (
+        "import time, sly, sqlalchemy, db, interp, lex, qa, parsetables, template_cache\n"
+        "start = time.perf_counter()\n"
+        "import parse\n"
+        "print(time.perf_counter() - start)\n"
+    )
+
+    def import_parse(parsetab):
+        env = { **os.environ, "RAIN_PARSETAB": parsetab }
+        times = []
+        for _ in range(repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", script],
+                cwd=PROJECT_DIR, env=env, check=True, capture_output=True, text=True
+            )
+            times.append(float(out.stdout))
+        return min(times)
+
+    report("import parse, grammar analysis", import_parse("0"))
+    report("import parse, precomputed tables", import_parse("1"))
+
+
+def bench_let(depth=4, repeat=2000):
+    # Compares native let nodes with the closure application they used to be
+    # desugared into, on the environment a real template evaluates in
+    from rain_types import AppC, FnC, IdC, LetC, NumC, EvalContext
+    from interp import interp
+
+    oracle = make_oracle()
+
+    def chain(bind):
+        body = IdC(f"x{depth - 1}")
+        for i in reversed(range(depth)):
+            value = NumC(i) if i == 0 else AppC(IdC("+"), [IdC(f"x{i - 1}"), NumC(1)])
+            body = bind(f"x{i}", value, body)
+        return body
+
+    def run(expr):
+        def evaluate():
+            for _ in range(repeat):
+                interp(expr, oracle.env, oracle.db, EvalContext(dict()))
+        return best_of(evaluate) / repeat
+
+    desugared = run(chain(lambda id, value, body: AppC(FnC([id], body), [value])))
+    native = run(chain(lambda id, value, body: LetC(id, value, body)))
+    report(f"{depth} chained lets, desugared to closures", desugared)
+    report(f"{depth} chained lets, LetC", native)
+    report("per-let overhead saved", (desugared - native) / depth)
+
+
+SAMPLE_SLOTS = { "professor0": "husmith", "course0": "CPE 464" }
+
+def bench_templates(repeat=5):
+    # Latency and peak traced memory of every template in templates.json
+    oracle = make_oracle()
+    oracle.load_templates(os.path.join(PROJECT_DIR, "templates.json"), workers=1)
+
+    for qformat, template in oracle.qa.items():
+        slots = { k: v for k, v in SAMPLE_SLOTS.items() if k in template.slots }
+        answer = lambda: oracle.answer(qformat, **slots)
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = best_of(answer, repeat)
+            tracemalloc.start()
+            answer()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        report(qformat[:48], seconds)
+        print(f"{'':<48} {peak / 1024:12.1f} KiB peak")
+
+
+ENGINE_TEMPLATES = {
+    "start hours of every section": (
+        '((sections.start_time.filter (fn (st) -> (ne? st ""))).map '
+            '(fn (st) -> (+ (if (eq? (st.find "PM") -1) 0 12) (num (st.slice 0 (st.find ":"))))))'
+    ),
+    "recursive fib 15": 'let fib = (fn (n) -> (if (le? n 1) n (+ (fib (- n 1)) (fib (- n 2))))) in (fib 15)',
+}
+
+def bench_engines(repeat=5):
+    # Same templates under each evaluation engine
+    from qa import ENGINES
+
+    for engine in ENGINES:
+        oracle = make_oracle(engine=engine)
+        for name, source in ENGINE_TEMPLATES.items():
+            oracle.add_qa(name, source)
+            report(f"{engine}: {name}", best_of(lambda: oracle.answer(name), repeat))
+
+
+def bench_recursion():
+    # Per-call cost of tail and non-tail recursion as depth grows. Templates
+    # too deep for an engine raise instead of starting over on the stack engine.
+    from qa import ENGINES
+
+    templates = {
+        "tail": 'let count = (fn (n acc) -> (if (le? n 0) acc (count (- n 1) (+ acc 1)))) in (count {} 0)',
+        "non-tail": 'let sum = (fn (n) -> (if (le? n 0) 0 (+ n (sum (- n 1))))) in (sum {})',
+    }
+    for engine in ENGINES:
+        oracle = make_oracle(engine=engine, fallback=None)
+        for kind, source in templates.items():
+            for depth in [100, 1000, 10000, 100000]:
+                name = f"{engine}: {kind} depth {depth}"
+                oracle.add_qa(name, source.format(depth))
+                try:
+                    report(f"{name}, per call", best_of(lambda: oracle.answer(name), 1) / depth)
+                except RecursionError:
+                    print(f"{name:<48} {'RecursionError':>15}")
+
+
+def bench_memo(repeat=3):
+    # Recursive fib with and without memoization of pure functions
+    from qa import ENGINES
+
+    source = ENGINE_TEMPLATES["recursive fib 15"].replace("15", "{}")
+    for engine in ENGINES:
+        oracle = make_oracle(engine=engine)
+        for n in [15, 20]:
+            for memoize in [False, True]:
+                name = f"{engine}: fib {n}{', memoized' if memoize else ''}"
+                oracle.add_qa(name, source.format(n), memoize=memoize)
+                report(name, best_of(lambda: oracle.answer(name), repeat))
+
+
+CSE_TEMPLATES = {
+    "invariant in filter": '(sections.filter (fn (s) -> (eq? s.title (course0.sections.first).title)))',
+    "repeated chain": '`{(course0.sections#instructor#name.dedup.length)} of {(course0.sections#instructor#name.dedup.length)}`',
+}
+
+def bench_cse(repeat=5):
+    # Templates with repeated and loop-invariant subexpressions, with and
+    # without optimize.share_subexprs
+    from qa import AnswerTemplate, ENGINES
+    from optimize import share_subexprs
+
+    for engine in ENGINES:
+        oracle = make_oracle(engine=engine)
+        for name, source in CSE_TEMPLATES.items():
+            ast = oracle.parse_answer(source)
+            for shared in [False, True]:
+                template = AnswerTemplate(
+                    source, share_subexprs(ast) if shared else ast, oracle.env, { "course0": "course" }, oracle.db, engine
+                )
+                seconds = best_of(lambda: template.evaluate(oracle.db, course0="CPE 464"), repeat)
+                report(f"{engine}: {name}{', shared' if shared else ''}", seconds)
+
+
+def bench_dispatch(repeat=5, n=10000):
+    # dot_access against the accessors infer.annotate_types resolves to
+    from interp import dot_access, entity_attr, bound_method
+    from entities.Professor import ProfessorEnt
+    from rain_types import EntV, ListV, StringV, EvalContext
+    import typeclasses as tcs
+
+    oracle = make_oracle()
+    prof = oracle.db.get_entity_default_search_col("professor", "husmith")
+    ent = EntV(prof, table=oracle.db.type_map["ProfessorEnt"], tablename="ProfessorEnt")
+    lst = ListV([StringV("a")])
+    ctx = EvalContext(dict(), session=oracle.db.session)
+    cases = {
+        "entity attribute": (ent, "name", entity_attr(ProfessorEnt, "name")),
+        "list method": (lst, "length", bound_method(ListV, tcs.ListT.length, "length")),
+    }
+    for name, (val, id, resolved) in cases.items():
+        dynamic = best_of(lambda: [dot_access(val, id, oracle.env, oracle.db, ctx) for _ in range(n)], repeat)
+        static = best_of(lambda: [resolved(val, oracle.env, oracle.db, ctx) for _ in range(n)], repeat)
+        report(f"{name}, dot_access", dynamic / n)
+        report(f"{name}, resolved", static / n)
+
+
+def bench_values(repeat=5):
+    # Memory and time to wrap large answers: every section, and each
+    # section's start time and title
+    from rain_types import rain_wrap
+    from entities.Section import SectionEnt
+
+    oracle = make_oracle()
+    rows = oracle.db.session.query(SectionEnt).all()
+    cases = {
+        "sections": rows,
+        "start times": [row.start_time for row in rows],
+        "titles and flags": [[row.title, row.days is None, 1] for row in rows],
+    }
+    for name, values in cases.items():
+        # Lists wrap their elements when they are first iterated
+        wrap = lambda: list(rain_wrap(values, oracle.db, oracle.env).value)
+        seconds = best_of(wrap, repeat)
+        tracemalloc.start()
+        wrapped = wrap()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report(f"{name} ({len(values)})", seconds)
+        print(f"{'':<48} {size / 1024:12.1f} KiB")
+        report(f"{name}, length only", best_of(lambda: len(rain_wrap(values, oracle.db, oracle.env).value), repeat))
+
+
+BUILTIN_TEMPLATES = {
+    "arithmetic loop": 'let loop = (fn (n acc) -> (if (le? n 0) acc (loop (- n 1) (+ acc (mod (* n 7) 3))))) in (loop 150 0)',
+    "list callbacks": '((sections.start_time.map (fn (st) -> (st.find ":"))).filter (fn (i) -> (gt? i 1))).length',
+}
+
+def bench_builtins(repeat=5):
+    # Templates dominated by calls to builtin operators and list methods
+    from qa import ENGINES
+
+    for engine in ENGINES:
+        oracle = make_oracle(engine=engine)
+        for name, source in BUILTIN_TEMPLATES.items():
+            oracle.add_qa(name, source, memoize=False)
+            report(f"{engine}: {name}", best_of(lambda: oracle.answer(name), repeat))
+
+
+SHORT_CIRCUIT_TEMPLATES = {
+    "or": '(or (eq? course0.title course0.title) ((sections.filter (fn (s) -> (eq? s.days "MWF"))).empty))',
+    "xor": '(xor (eq? course0.title course0.title) ((sections.filter (fn (s) -> (eq? s.days "MWF"))).empty))',
+}
+
+def bench_short_circuit(repeat=5):
+    # or skips its right operand when the left one is true. xor always
+    # evaluates both, so it shows what the skipped query costs.
+    from qa import ENGINES
+
+    for engine in ENGINES:
+        oracle = make_oracle(engine=engine)
+        for name, source in SHORT_CIRCUIT_TEMPLATES.items():
+            qformat = f"{name} {{course}}"
+            oracle.add_qa(qformat, source)
+            report(f"{engine}: {name}", best_of(lambda: oracle.answer(qformat.lower(), course0="CPE 464"), repeat))
+
+
+PIPELINE_TEMPLATES = {
+    "most instructors": '(courses.max_by (fn (course) -> (course.sections#instructor#name.dedup.length))).name',
+    "first after filter": '(((sections.start_time.map (fn (st) -> (st.find ":"))).filter (fn (i) -> (gt? i 1))).first)',
+    "length after filter": '(((sections.start_time.map (fn (st) -> (st.find ":"))).filter (fn (i) -> (gt? i 1))).length)',
+}
+
+def bench_pipelines(repeat=5):
+    # Chains of map, filter and # over whole tables, with the peak memory
+    # of one answer
+    oracle = make_oracle()
+    for name, source in PIPELINE_TEMPLATES.items():
+        oracle.add_qa(name, source)
+        report(name, best_of(lambda: oracle.answer(name), repeat))
+        tracemalloc.start()
+        oracle.answer(name)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{'':<48} {peak / 1024:12.1f} KiB peak")
+
+
+def bench_numeric(repeat=5, n=100000):
+    # List aggregates over n numbers, with and without NumPy arrays. Each run
+    # starts from a fresh list, so converting it to an array is included.
+    import random
+    import rain_types
+    from rain_types import LazyList, LazySeq, ListV, NumberV, EvalContext
+    from typeclasses import ListT
+
+    oracle = make_oracle()
+    nums = [random.randint(0, 1000) for _ in range(n)]
+    ctx = EvalContext(dict())
+    lists = {
+        "python values": lambda: ListV(LazyList(nums, oracle.db, oracle.env)),
+        "NumberVs": lambda: ListV(LazySeq([NumberV(x) for x in nums], ())),
+    }
+    aggregates = {
+        "max": lambda xs: ListT.max(xs, oracle.env, oracle.db, ctx),
+        "sum": lambda xs: ListT.sum(xs, oracle.env, oracle.db, ctx),
+        "sort": lambda xs: ListT.sort(xs, oracle.env, oracle.db, ctx),
+        "max, min, sum and argmax": lambda xs: [
+            method(xs, oracle.env, oracle.db, ctx) for method in [ListT.max, ListT.min, ListT.sum, ListT.argmax]
+        ],
+    }
+    numpy = rain_types.np
+    for list_name, make_list in lists.items():
+        for name, aggregate in aggregates.items():
+            for np in [None, numpy]:
+                rain_types.np = np
+                lists_made = [make_list() for _ in range(repeat)]
+                seconds = best_of(lambda: aggregate(lists_made.pop()), repeat)
+                report(f"{name} of {n} {list_name}{', numpy' if np is not None else ''}", seconds)
+    rain_types.np = numpy
+
+
+SELECTION_TEMPLATES = {
+    "sort_by, take 3": '((sections.sort_by (fn (s) -> s.start_time)).take 3)#title',
+    "bottom_k 3": '(sections.bottom_k (fn (s) -> s.start_time) 3)#title',
+    "bottom_k 3, computed key": '(sections.bottom_k (fn (s) -> (s.start_time.find ":")) 3)#title',
+    "list sort_by, take 3": '(((sections.take 2000).sort_by (fn (s) -> s.start_time)).take 3)#title',
+    "list bottom_k 3": '((sections.take 2000).bottom_k (fn (s) -> s.start_time) 3)#title',
+}
+
+def bench_selection(repeat=5):
+    # Taking the first rows in key order by sorting everything, and with
+    # top_k/bottom_k. On tables a plain column key becomes ORDER BY ... LIMIT.
+    oracle = make_oracle()
+    for name, source in SELECTION_TEMPLATES.items():
+        oracle.add_qa(name, source)
+        report(name, best_of(lambda: oracle.answer(name), repeat))
+
+
+PUSHDOWN_TEMPLATES = {
+    "filter by column": '(sections.filter (fn (s) -> (eq? s.course_title "CPE 464")))#title',
+    "filter by slot": '(sections.filter (fn (s) -> (eq? s.course_title course0.title)))#title',
+    "filter through relationship": '(sections.filter (fn (s) -> (eq? s.instructor.name "Jim Widmann")))#title',
+    "filter, partly translated": '(sections.filter (fn (s) -> (and (eq? s.days "TR") (gt? (s.start_time.find ":") 1))))#title',
+    "filter by column range": '(sections.filter (fn (s) -> (and (gt? s.start_time "09") (lt? s.start_time "11"))))#title',
+    "map to column": '(sections.map (fn (s) -> s.start_time))',
+}
+
+def bench_pushdown(repeat=5):
+    # Table filters and maps run by the database, and in Python for
+    # comparison. The counters show which path each one took.
+    import pushdown
+
+    oracle = make_oracle()
+    for name, source in PUSHDOWN_TEMPLATES.items():
+        qformat = f"{name} {{course}}"
+        oracle.add_qa(qformat, source)
+        answer = lambda: oracle.answer_with_counters(qformat.lower(), course0="CPE 464")
+        _, counters = answer()
+        paths = ", ".join(key for key in counters if key != "entities")
+        report(f"{name} ({paths})", best_of(answer, repeat))
+
+    translate = pushdown.filter_clauses, pushdown.projection
+    pushdown.filter_clauses = lambda fn, table, db, ctx: ([], False)
+    pushdown.projection = lambda fn, table, db, ctx: None
+    try:
+        for name in PUSHDOWN_TEMPLATES:
+            qformat = f"{name} {{course}}".lower()
+            report(f"{name}, in Python", best_of(lambda: oracle.answer(qformat, course0="CPE 464"), repeat))
+    finally:
+        pushdown.filter_clauses, pushdown.projection = translate
+
+
+AGGREGATE_TEMPLATES = {
+    "collection length": '(prof0.teaches.length)',
+    "collection empty": '(prof0.advises.empty)',
+    "filter, length": '((sections.filter (fn (s) -> (eq? s.days "TR"))).length)',
+    "column max": '((sections.map (fn (s) -> s.start_time)).max)',
+    "column dedup": '((sections.map (fn (s) -> s.days)).dedup.length)',
+    "length per course": '(courses.max_by (fn (course) -> (course.sections.length))).name',
+}
+
+def bench_aggregates(repeat=5):
+    # Aggregates over tables and unloaded collections asked of the database,
+    # and over the loaded rows for comparison
+    import pushdown
+
+    oracle = make_oracle()
+    qformats = {}
+    for name, source in AGGREGATE_TEMPLATES.items():
+        qformats[name] = f"{name} {{prof0:professor}}".lower()
+        oracle.add_qa(qformats[name], source)
+        report(name, best_of(lambda: oracle.answer(qformats[name], prof0="jwidmann"), repeat))
+
+    aggregate = pushdown.unloaded, pushdown.collections
+    pushdown.unloaded = lambda vals: False
+    pushdown.collections = lambda cls: frozenset()
+    try:
+        for name in AGGREGATE_TEMPLATES:
+            report(f"{name}, rows loaded", best_of(lambda: oracle.answer(qformats[name], prof0="jwidmann"), repeat))
+    finally:
+        pushdown.unloaded, pushdown.collections = aggregate
+
+
+TABLE_ATTRIBUTE_TEMPLATES = {
+    "column": '`{sections.start_time}`',
+    "column property": '`{professors.email}`',
+    "column property, length": '(professors.name.length)',
+    "column, dedup": '(sections.days.dedup.length)',
+}
+
+def bench_table_attributes(repeat=5):
+    # Attribute lists of whole tables, which select only the column
+    oracle = make_oracle()
+    for name, source in TABLE_ATTRIBUTE_TEMPLATES.items():
+        oracle.add_qa(name, source)
+        report(name, best_of(lambda: oracle.answer(name), repeat))
+
+
+def bench_pound_chains(repeat=3):
+    # "What professors teach {course}?" for every course in the catalog, with
+    # the # chain as one joined query, and reading each hop for comparison.
+    # Queries counts the statements sent to the database.
+    import pushdown
+    import sqlalchemy as sqa
+    from entities.Course import CourseEnt
+
+    oracle = make_oracle()
+    oracle.load_templates(os.path.join(PROJECT_DIR, "templates.json"), workers=1)
+    qformat = "what professors teach {course}?"
+    titles = [title for (title,) in oracle.db.session.query(CourseEnt.title)]
+    answer_all = lambda: [oracle.answer(qformat, course0=title) for title in titles]
+
+    queries = [0]
+    def count(*args):
+        queries[0] += 1
+    def run(name):
+        queries[0] = 0
+        answer_all()
+        report(f"{len(titles)} courses, {name} ({queries[0]} queries)", best_of(answer_all, repeat))
+
+    sqa.event.listen(oracle.db.engine, "before_cursor_execute", count)
+    follow = pushdown.follow
+    try:
+        run("joined")
+        pushdown.follow = lambda vals, id, db, env: None
+        run("per hop")
+    finally:
+        pushdown.follow = follow
+        sqa.event.remove(oracle.db.engine, "before_cursor_execute", count)
+
+
+def bench_eager_loading(repeat=5):
+    # Templates that read relationships of the professor slot, with the
+    # relationships loaded by the plan from infer.annotate_types and loaded as
+    # they're read. The professor teaches the most courses, so reading each
+    # section's course lazily costs the most queries.
+    import pushdown
+    import sqlalchemy as sqa
+    from entities.Section import SectionEnt
+
+    session = make_oracle().db.session
+    courses = sqa.func.count(sqa.distinct(SectionEnt.course_title))
+    busiest, n = (
+        session.query(SectionEnt.instructor_alias, courses)
+        .filter(SectionEnt.start_time != "").group_by(SectionEnt.instructor_alias)
+        .order_by(courses.desc()).first()
+    )
+    course = (
+        session.query(SectionEnt.course_title)
+        .filter(SectionEnt.instructor_alias == busiest, SectionEnt.start_time != "").first()[0]
+    )
+    slots = { "professor0": busiest, "course0": course }
+
+    queries = [0]
+    def count(*args):
+        queries[0] += 1
+    def run(name):
+        oracle = make_oracle()
+        oracle.load_templates(os.path.join(PROJECT_DIR, "templates.json"), workers=1)
+        sqa.event.listen(oracle.db.engine, "before_cursor_execute", count)
+        for qformat, template in oracle.qa.items():
+            if "professor0" not in template.slots:
+                continue
+            answer = lambda: oracle.answer(qformat, **{ k: v for k, v in slots.items() if k in template.slots })
+            queries[0] = 0
+            answer()
+            report(f"{qformat[:30]}, {name} ({queries[0]} queries)", best_of(answer, repeat))
+
+    print(f"{busiest}, {n} courses, {course}")
+    load_options = pushdown.load_options
+    try:
+        run("planned")
+        pushdown.load_options = lambda cls, paths: ()
+        run("lazy")
+    finally:
+        pushdown.load_options = load_options
+
+
+def bench_concurrent(repeat=3, n=200):
+    # n answers from one shared Oracle, in turn and from a thread pool. Each
+    # answer has its own EvalContext and session, so they can run together.
+    from concurrent.futures import ThreadPoolExecutor
+    from entities.Professor import ProfessorEnt
+
+    oracle = make_oracle()
+    oracle.add_qa("email {professor}", "`{professor0.name}'s email is {professor0.email}`")
+    aliases = [alias for (alias,) in oracle.db.session.query(ProfessorEnt.alias).limit(n)]
+    answer = lambda alias: oracle.answer("email {professor}", professor0=alias)
+    report(f"{len(aliases)} answers, serial", best_of(lambda: [answer(alias) for alias in aliases], repeat))
+    for workers in [4, 16]:
+        with ThreadPoolExecutor(workers) as pool:
+            seconds = best_of(lambda: list(pool.map(answer, aliases)), repeat)
+        report(f"{len(aliases)} answers, {workers} threads", seconds)
+
+
+BENCHMARKS = {
+    "import": bench_import,
+    "let": bench_let,
+    "templates": bench_templates,
+    "engines": bench_engines,
+    "recursion": bench_recursion,
+    "memo": bench_memo,
+    "cse": bench_cse,
+    "dispatch": bench_dispatch,
+    "values": bench_values,
+    "builtins": bench_builtins,
+    "short-circuit": bench_short_circuit,
+    "pipelines": bench_pipelines,
+    "numeric": bench_numeric,
+    "selection": bench_selection,
+    "concurrent": bench_concurrent,
+    "pushdown": bench_pushdown,
+    "aggregates": bench_aggregates,
+    "table-attributes": bench_table_attributes,
+    "pound-chains": bench_pound_chains,
+    "eager-loading": bench_eager_loading,
+}
+
+
+if __name__=="__main__":
+    # python bench.py [name ...]
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,183 @@
+import operator
+from rain_types import *
+from interp import interp_appC, lookup_id, dot_access, pound_access, bracket_id, force
+from rainmethod import lazy_mask
+
+# Compiles ExprC trees into nested Python closures. Each closure takes
+# (env, db, ctx) like interp, but the node kind, the comparison operator
+# and the frame that binds each local variable are all decided here, once,
+# instead of on every evaluation.
+
+def compile_expr(expr, scopes=()):
+    # scopes holds the names bound by each enclosing frame, innermost first,
+    # mirroring the Scope chain the compiled code will run in
+    match expr:
+        case StringC(s):
+            return constant(string_value(s))
+        case NumC(n):
+            return constant(number_value(n))
+        case ValC(val):
+            return constant(val)
+        case IdC(id):
+            return compile_id(id, scopes)
+        case FnC(args, body):
+            return compile_fn(args, body, scopes)
+        case LetC(id, valExpr, body, lazy=lazy):
+            return compile_let(id, valExpr, body, lazy, scopes)
+        case LetRecC(id, FnC(args, fnBody), body, memo=memo):
+            return compile_letrec(id, args, fnBody, body, memo, scopes)
+        case ArrC(exprs):
+            codes = [compile_expr(subexpr, scopes) for subexpr in exprs]
+            return lambda env, db, ctx: ListV([code(env, db, ctx) for code in codes])
+        case DotAccessC(expr, IdC(id), resolved=resolved):
+            code = compile_expr(expr, scopes)
+            if resolved is not None:
+                return lambda env, db, ctx: resolved(code(env, db, ctx), env, db, ctx)
+            return lambda env, db, ctx: dot_access(code(env, db, ctx), id, env, db, ctx)
+        case DotAccessC(_, idc):
+            raise Exception(f"Attempted dotaccess with non-id expr {idc}")
+        case PoundAccessC(expr, IdC(id)):
+            code = compile_expr(expr, scopes)
+            return lambda env, db, ctx: pound_access(code(env, db, ctx), id, env, db, ctx)
+        case PoundAccessC(_, notId):
+            raise Exception(f"Attemped pound access with non-id {notId}")
+        case BracketAccessC(expr0, expr1):
+            code0 = compile_expr(expr0, scopes)
+            code1 = compile_expr(expr1, scopes)
+            return lambda env, db, ctx: dot_access(
+                code0(env, db, ctx), bracket_id(code1(env, db, ctx)), env, db, ctx
+            )
+        case AppC(fnExpr, appArgs):
+            return compile_app(fnExpr, appArgs, scopes)
+        case FStringC(fstring, exprs):
+            codes = [compile_expr(subexpr, scopes) for subexpr in exprs]
+            return lambda env, db, ctx: string_value(fstring.format(*[code(env, db, ctx) for code in codes]))
+        case CompC(expr0, comp, expr1):
+            return compile_comp(expr0, comp, expr1, scopes)
+        case IfC(cond, l, r):
+            return compile_if(cond, l, r, scopes)
+        case _:
+            raise Exception(f"Can't compile expression {expr}")
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt
+}
+
+class LazyFrame(frozenset):
+    # Names bound to ThunkVs by a lazy let
+    pass
+
+def constant(val):
+    return lambda env, db, ctx: val
+
+def compile_id(id, scopes):
+    for depth, names in enumerate(scopes):
+        if id in names:
+            break
+    else:
+        # Bound by the slot or base environment
+        return lambda env, db, ctx: lookup_id(id, env, db, ctx)
+
+    lookup = compile_local(id, depth)
+    if isinstance(names, LazyFrame):
+        return lambda env, db, ctx: force(lookup(env, db, ctx), db, ctx)
+    return lookup
+
+def compile_local(id, depth):
+    match depth:
+        case 0:
+            return lambda env, db, ctx: env.frame[id]
+        case 1:
+            return lambda env, db, ctx: env.parent.frame[id]
+        case 2:
+            return lambda env, db, ctx: env.parent.parent.frame[id]
+        case _:
+            def lookup_local(env, db, ctx):
+                for _ in range(depth):
+                    env = env.parent
+                return env.frame[id]
+            return lookup_local
+
+def compile_fn(args, body, scopes):
+    bodyCode = compile_expr(body, (frozenset(args), *scopes))
+    return lambda env, db, ctx: CloV(body, env=env, args=args, code=bodyCode)
+
+def compile_let(id, valExpr, body, lazy, scopes):
+    valCode = compile_expr(valExpr, scopes)
+    if lazy:
+        bodyCode = compile_expr(body, (LazyFrame([id]), *scopes))
+        return lambda env, db, ctx: bodyCode(env.bind(id, ThunkV(valCode, env=env)), db, ctx)
+    bodyCode = compile_expr(body, (frozenset([id]), *scopes))
+    return lambda env, db, ctx: bodyCode(env.bind(id, valCode(env, db, ctx)), db, ctx)
+
+def compile_letrec(id, args, fnBody, body, memo, scopes):
+    recScopes = (frozenset([id]), *scopes)
+    fnCode = compile_expr(fnBody, (frozenset(args), *recScopes))
+    bodyCode = compile_expr(body, recScopes)
+
+    def letrec(env, db, ctx):
+        frame = dict()
+        recEnv = env.extend(frame)
+        frame[id] = CloV(fnBody, env=recEnv, args=args, code=fnCode, memo=dict() if memo else None)
+        return bodyCode(recEnv, db, ctx)
+    return letrec
+
+def compile_app(fnExpr, appArgs, scopes):
+    fnCode = compile_expr(fnExpr, scopes)
+    argCodes = [compile_expr(arg, scopes) for arg in appArgs]
+
+    def app(env, db, ctx):
+        fn = fnCode(env, db, ctx)
+        if type(fn) is OpV:
+            mask = lazy_mask(fn.value, len(argCodes))
+            if mask is None:
+                args = [code(env, db, ctx) for code in argCodes]
+            else:
+                args = [
+                    ThunkV(code, env=env) if isLazy else code(env, db, ctx)
+                    for code, isLazy in zip(argCodes, mask)
+                ]
+            return rain_wrap(fn.value(None, env, db, ctx, *args), db, env)
+        args = [code(env, db, ctx) for code in argCodes]
+        # Calls between compiled closures skip interp_appC's dispatch
+        if type(fn) is CloV and fn.code is not None and fn.memo is None:
+            if len(fn.args) != len(args):
+                raise Exception(f"Invalid number of arguments for fn {fn.value}")
+            return fn.code(fn.env.extend(dict(zip(fn.args, args))), db, ctx)
+        return interp_appC(fn, args, env, db, ctx, False)
+    return app
+
+def compile_comp(expr0, comp, expr1, scopes):
+    code0 = compile_expr(expr0, scopes)
+    code1 = compile_expr(expr1, scopes)
+    op = COMPARISONS.get(comp)
+    if op is None:
+        raise Exception(f"Unknown comparison operator {comp}")
+
+    def compare(env, db, ctx):
+        val0 = code0(env, db, ctx)
+        val1 = code1(env, db, ctx)
+        if (type(val0) is NumberV and type(val1) is NumberV) or (type(val0) is StringV and type(val1) is StringV):
+            return TRUE if op(val0.value, val1.value) else FALSE
+        return FALSE
+    return compare
+
+def compile_if(cond, l, r, scopes):
+    condCode = compile_expr(cond, scopes)
+    lCode = compile_expr(l, scopes)
+    rCode = compile_expr(r, scopes)
+
+    def branch(env, db, ctx):
+        val = condCode(env, db, ctx)
+        if type(val) is BoolV:
+            if val.value is True:
+                return lCode(env, db, ctx)
+            if val.value is False:
+                return rCode(env, db, ctx)
+        raise Exception("Non-bool if condition", val)
+    return branch
@@ -21,7 +21,10 @@ class Database:
         self.entity_types = { e.__tablename__: e.__name__ for e in entities }
         self.engine = sa.create_engine(database_url, echo=echo)
         self.inspector = sa.inspect(self.engine)
-        self.session = sessionmaker(bind=self.engine)()
+        # Evaluations each open their own session, see AnswerTemplate.evaluate.
+        # self.session is for loading data and other single-threaded use.
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = self.Session()
         self.type_map = self._create_type_mapping()
         
     @property
@@ -49,18 +52,19 @@ class Database:
         if not entity.__tablename__ in self.inspector.get_table_names():
             entity.__table__.create(bind=self.engine)
     
-    def get_entity(self, ent, ent_col, ent_val):
+    def get_entity(self, ent, ent_col, ent_val, session=None, options=()):
         table = self.entity_names.get(ent)
         return (
-            self.session
+            (session or self.session)
             .query(table)
+            .options(*options)
             .filter(getattr(table, ent_col) == ent_val)
             .one_or_none()
         )
     
-    def get_entity_default_search_col(self, ent, ent_val):
+    def get_entity_default_search_col(self, ent, ent_val, session=None, options=()):
         search_col = self.entity_search_cols.get(self.entity_names.get(ent))
-        return self.get_entity(ent, search_col, ent_val)
+        return self.get_entity(ent, search_col, ent_val, session, options)
     
     def get_prop_from_entity(self, ent, ent_val, prop):
         search_col = self.entity_search_cols.get(self.entity_names.get(ent))
@@ -0,0 +1,337 @@
+from dataclasses import replace
+import rainmethod as rmethod
+import typeclasses as tcs
+from typeclasses import NumberT, StringT, BoolT, NoneT, ListT, EntT, TableT, CloT, PyCloT, OpT, ObjectT, AnyT
+from rain_types import *
+from interp import entity_attr, bound_method, table_method, object_method
+from optimize import map_children, children
+
+# Static types for templates, inferred when they are registered. Slot types
+# come from the question format and attribute types from Database.type_map,
+# so every dot access on an entity, list, string or table has a known
+# receiver and is either resolved to an accessor now or rejected as an
+# error. Anything that can't be known ahead of time is AnyT and is left to
+# dot_access.
+
+VALUE_CLASSES = {
+    "number": NumberV,
+    "string": StringV,
+    "bool": BoolV,
+    "none": NoneV,
+    "list": ListV
+}
+
+ARITHMETIC = {
+    rmethod.RAIN_ADD, rmethod.RAIN_SUBTRACT, rmethod.RAIN_MULTIPLY,
+    rmethod.RAIN_DIVIDE, rmethod.RAIN_MOD, rmethod.RAIN_EXP
+}
+
+PREDICATES = {
+    rmethod.RAIN_EQUAL, rmethod.RAIN_NOT_EQUAL, rmethod.RAIN_GREATER_THAN, rmethod.RAIN_GREATER_TO_OR_EQUAL,
+    rmethod.RAIN_LESS_THAN, rmethod.RAIN_LESS_TO_OR_EQUAL, rmethod.RAIN_NOT, rmethod.RAIN_AND,
+    rmethod.RAIN_OR, rmethod.RAIN_XOR, rmethod.RAIN_NAND, rmethod.RAIN_NOR, rmethod.RAIN_XNOR
+}
+
+def join(types):
+    # The type of a value that may come from any of types
+    types = list(types)
+    if types and all(t == types[0] for t in types):
+        return types[0]
+    return AnyT()
+
+def branch_types(clauses):
+    # The value types of (test value ... default) clauses of cond or case
+    types = list(clauses[1::2])
+    if len(clauses) % 2 == 1:
+        types.append(clauses[-1])
+    return types
+
+def type_of_value(val, db):
+    match val:
+        case NumberV():
+            return NumberT()
+        case StringV():
+            return StringT()
+        case BoolV():
+            return BoolT()
+        case NoneV():
+            return NoneT()
+        case ListV(vals) if isinstance(vals, LIST_TYPES):
+            return ListT(subtype=join(type_of_value(subval, db) for subval in vals))
+        case TableV(table):
+            return TableT(tablename=table.__name__)
+        case LazyEntV(tablename=tablename):
+            return EntT(tablename=db.entity_types[tablename])
+        case EntV(ent):
+            return EntT(tablename=type(ent).__name__)
+        case ObjectV(contents):
+            return ObjectT(contents=contents)
+        case OpV(op):
+            return OpT(op=op)
+        case _:
+            return AnyT()
+
+def scope_types(scope, db):
+    frames = []
+    while scope is not None:
+        frames.append(scope.frame)
+        scope = scope.parent
+    types = dict()
+    for frame in reversed(frames):
+        types.update({ id: slot_type(id, val, db) for id, val in frame.items() })
+    return types
+
+def slot_type(id, val, db):
+    # Slot entities start the relationship paths of the loading plan
+    t = type_of_value(val, db)
+    return replace(t, path=(id,)) if type(val) is LazyEntV else t
+
+class TypeInference:
+    def __init__(self, db):
+        self.db = db
+        self.classes = { cls.__name__: cls for cls in db.entities }
+        # Accessor for each DotAccessC, by id, from every context it was
+        # inferred in. None means that context couldn't resolve it.
+        self.resolutions = dict()
+        self.closures = []
+        self.applied = set()
+        self.active = set()
+        # Relationship paths read from slot entities, see EntT.path
+        self.paths = set()
+
+    def infer(self, expr, env):
+        match expr:
+            case StringC():
+                return StringT()
+            case NumC():
+                return NumberT()
+            case ValC(val):
+                return type_of_value(val, self.db)
+            case IdC(id):
+                if id not in env:
+                    raise Exception(f"ID {id} is used before binding")
+                return env[id]
+            case FnC():
+                clo = CloT(fn=expr, env=env)
+                self.closures.append(clo)
+                return clo
+            case LetC(id, valExpr, body):
+                return self.infer(body, { **env, id: self.infer(valExpr, env) })
+            case LetRecC(id, fnExpr, body):
+                recEnv = dict(env)
+                recEnv[id] = CloT(fn=fnExpr, env=recEnv)
+                self.closures.append(recEnv[id])
+                return self.infer(body, recEnv)
+            case ArrC(exprs):
+                return ListT(subtype=join(self.infer(subexpr, env) for subexpr in exprs))
+            case DotAccessC(subexpr, IdC(id)):
+                return self.dot(self.infer(subexpr, env), id, expr)
+            case PoundAccessC(subexpr, IdC(id)):
+                return self.pound(self.infer(subexpr, env), id)
+            case AppC(fnExpr, appArgs):
+                fnT = self.infer(fnExpr, env)
+                return self.apply(fnT, [self.infer(arg, env) for arg in appArgs])
+            case FStringC(_, exprs):
+                for subexpr in exprs:
+                    self.infer(subexpr, env)
+                return StringT()
+            case CompC(expr0, _, expr1):
+                self.infer(expr0, env)
+                self.infer(expr1, env)
+                return BoolT()
+            case IfC(cond, l, r):
+                self.infer(cond, env)
+                return join([self.infer(l, env), self.infer(r, env)])
+            case _:
+                for subexpr in children(expr):
+                    self.infer(subexpr, env)
+                return AnyT()
+
+    def resolve(self, node, accessor):
+        if node is not None:
+            self.resolutions.setdefault(id(node), []).append(accessor)
+
+    def dot(self, t, id, node=None):
+        match t:
+            case EntT(tablename=tablename) if tablename is not None:
+                attrs = self.db.type_map[tablename]
+                if id not in attrs:
+                    raise Exception(f"{id} is not a valid attribute of {tablename}")
+                self.resolve(node, (entity_attr, self.classes[tablename], id))
+                return self.follow(t, id, attrs[id])
+            case TableT(tablename=tablename) if tablename is not None:
+                attrs = self.db.type_map[tablename]
+                if id in attrs:
+                    self.resolve(node, None)
+                    return ListT(subtype=attrs[id])
+                attr = self.method(tcs.TableT, id, t)
+                self.resolve(node, (table_method, self.classes[tablename], attr, id))
+                return PyCloT(typeclass=tcs.TableT, method=id, selfT=t)
+            case ObjectT(contents=contents):
+                attr = self.method(contents, id, t)
+                self.resolve(node, (object_method, contents, attr, id))
+                return PyCloT(typeclass=contents, method=id)
+            case PyCloT():
+                # Dot access on a method applies it first
+                self.resolve(node, None)
+                return self.dot(self.apply(t, []), id)
+            case AnyT():
+                self.resolve(node, None)
+                return t
+            case _:
+                valueType = VALUE_CLASSES.get(t.t)
+                if valueType is None:
+                    raise Exception(f"Value of type {t.t} has no method '{id}'")
+                attr = self.method(tcs.VALUE_MAP[t.t], id, t)
+                self.resolve(node, (bound_method, valueType, attr, id))
+                return PyCloT(typeclass=tcs.VALUE_MAP[t.t], method=id, selfT=t)
+
+    def follow(self, t, id, attrT):
+        # Relationships of entities reached from a slot extend its path.
+        # Paths through # aren't kept, pushdown.follow joins those.
+        if t.path is None:
+            return attrT
+        path = (*t.path, id)
+        match attrT:
+            case EntT():
+                self.paths.add(path)
+                return replace(attrT, path=path)
+            case ListT(subtype=EntT() as subtype):
+                self.paths.add(path)
+                return replace(attrT, subtype=replace(subtype, path=path))
+            case _:
+                return attrT
+
+    def method(self, typeclass, id, t):
+        attr = getattr(typeclass, id, None)
+        if not callable(attr):
+            raise Exception(f"Value of type {t.t} has no method '{id}'")
+        return attr
+
+    def pound(self, t, id):
+        match t:
+            case ListT(subtype=EntT(tablename=tablename)) if tablename is not None:
+                attrs = self.db.type_map[tablename]
+                if id in attrs:
+                    return ListT(subtype=attrs[id])
+                if not hasattr(self.classes[tablename], id):
+                    raise Exception(f"{id} is not a valid attribute of {tablename}")
+                return ListT(subtype=AnyT())
+            case ListT() | AnyT():
+                return ListT(subtype=AnyT())
+            case _:
+                raise Exception(f"Attempted pound access on non-list of type {t.t}")
+
+    def apply(self, fnT, argTs):
+        match fnT:
+            case CloT(fn=FnC(args, body), env=cloEnv):
+                key = id(fnT.fn)
+                self.applied.add(key)
+                # Recursive calls are typed AnyT rather than inferred again
+                if key in self.active or len(args) != len(argTs):
+                    return AnyT()
+                self.active.add(key)
+                try:
+                    return self.infer(body, { **cloEnv, **dict(zip(args, argTs)) })
+                finally:
+                    self.active.discard(key)
+            case PyCloT(typeclass=typeclass, method=method, selfT=selfT):
+                if selfT is None:
+                    # Accessed through List or String, so self is the first argument
+                    if not argTs:
+                        return AnyT()
+                    selfT, argTs = argTs[0], argTs[1:]
+                return self.method_result(typeclass, method, selfT, argTs)
+            case OpT(op=op) if op in PREDICATES:
+                return BoolT()
+            case OpT(op=op) if op in ARITHMETIC:
+                return join(argTs) if join(argTs) in (NumberT(), StringT()) else AnyT()
+            case OpT(op=rmethod.RAIN_TO_NUM):
+                return NumberT()
+            case OpT(op=rmethod.RAIN_TO_STR):
+                return StringT()
+            case OpT(op=rmethod.RAIN_COND):
+                return join(branch_types(argTs))
+            case OpT(op=rmethod.RAIN_CASE):
+                return join(branch_types(argTs[1:]))
+            case _:
+                return AnyT()
+
+    def method_result(self, typeclass, method, selfT, argTs):
+        arg = lambda i: argTs[i] if i < len(argTs) else AnyT()
+        if typeclass is tcs.TableT:
+            # Table methods run the list method on every row
+            tablename = selfT.tablename if type(selfT) is TableT else None
+            selfT = ListT(subtype=EntT(tablename=tablename) if tablename is not None else AnyT())
+            typeclass = tcs.ListT
+            if method == "rows":
+                return selfT
+
+        if typeclass is tcs.StringT:
+            match method:
+                case "startswith" | "endswith" | "contains":
+                    return BoolT()
+                case "find":
+                    return NumberT()
+                case _:
+                    return StringT()
+        if typeclass is not tcs.ListT:
+            return AnyT()
+
+        sub = selfT.subtype if type(selfT) is ListT else AnyT()
+        match method:
+            case "map":
+                return ListT(subtype=self.apply(arg(0), [sub]))
+            case "filter" | "sort_by" | "top_k" | "bottom_k" | "take_while":
+                self.apply(arg(0), [sub])
+                return selfT
+            case "max_by" | "min_by":
+                self.apply(arg(0), [sub])
+                return sub
+            case "foldl":
+                return join([arg(1), self.apply(arg(0), [arg(1), sub])])
+            case "rest" | "dedup" | "sort" | "take":
+                return selfT
+            case "first" | "max" | "min" | "at":
+                return sub
+            case "empty" | "contains":
+                return BoolT()
+            case "grammatical_join" | "gjoin":
+                return StringT()
+            case "count_where":
+                self.apply(arg(0), [sub])
+                return NumberT()
+            case "length" | "find" | "sum" | "mean" | "argmax" | "argmin":
+                return NumberT()
+            case _:
+                return AnyT()
+
+    def infer_unapplied(self):
+        # Functions that were never applied during inference, e.g. ones passed
+        # to a value of unknown type, are checked with arguments of unknown type
+        i = 0
+        while i < len(self.closures):
+            clo = self.closures[i]
+            if id(clo.fn) not in self.applied:
+                self.apply(clo, [AnyT()] * len(clo.fn.args))
+            i += 1
+
+    def annotate(self, expr):
+        accessors = self.resolutions.get(id(expr))
+        rebuilt = map_children(expr, self.annotate)
+        if type(expr) is DotAccessC and accessors and all(a is not None and a == accessors[0] for a in accessors):
+            factory, *args = accessors[0]
+            rebuilt = replace(rebuilt, resolved=factory(*args))
+        return rebuilt
+
+def annotate_types(ast, env, db):
+    # Raises on accesses that can never succeed. Returns ast with every dot
+    # access that always has the same kind of receiver resolved, and the
+    # relationship paths read from each slot, as { slot: {(key, ...)} }.
+    inference = TypeInference(db)
+    inference.infer(ast, scope_types(env, db))
+    inference.infer_unapplied()
+    loads = dict()
+    for slot, *path in inference.paths:
+        loads.setdefault(slot, set()).add(tuple(path))
+    return inference.annotate(ast), loads
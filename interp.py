@@ -1,156 +1,262 @@
 from rain_types import *
-from copy import deepcopy
+from functools import partial
 import re
 import typeclasses as tcs
+import pushdown
+from rainmethod import unbound, lazy_mask
 from pprint import pprint
 import sqlalchemy as sqa
 
 def rain_compare(val0, val1, comp):
     match comp:
-        case "==": return BoolV(val0 == val1)
-        case "!=": return BoolV(val0 != val1)
-        case ">=": return BoolV(val0 >= val1)
-        case "<=": return BoolV(val0 <= val1)
-        case ">": return BoolV(val0 > val1)
-        case "<": return BoolV(val0 < val1)
+        case "==": return bool_value(val0 == val1)
+        case "!=": return bool_value(val0 != val1)
+        case ">=": return bool_value(val0 >= val1)
+        case "<=": return bool_value(val0 <= val1)
+        case ">": return bool_value(val0 > val1)
+        case "<": return bool_value(val0 < val1)
         case _: raise Exception(f"Unknown comparison operator {comp}")
 
-def interp_appC(expr, appArgs, env, db, hints, interpArgs=True):
+MEMO_LIMIT = 10000
+MEMO_KEY_TYPES = (NumberV, StringV, BoolV, NoneV)
+
+def memo_key(args):
+    # Only calls on plain data are memoized, never on tables or entities
+    for arg in args:
+        if type(arg) not in MEMO_KEY_TYPES:
+            return None
+    return tuple(args)
+
+def run_closure(clo, args, db, ctx):
+    if len(clo.args) != len(args):
+        raise Exception(f"Invalid number of arguments for fn {clo.value}")
+    cloEnv = clo.env.extend(dict(zip(clo.args, args)))
+    if clo.code is not None:
+        return clo.code(cloEnv, db, ctx)
+    return interp(clo.value, cloEnv, db, ctx)
+
+def interp_appC(expr, appArgs, env, db, ctx, interpArgs=True):
     match expr:
-        case CloV(expr, env=cloEnv, args=cloArgs, recurse=recurse):
-            if len(cloArgs) != len(appArgs):
-                raise Exception(f"Invalid number of arguments for fn {expr}")
-            if interpArgs is False:
-                interpedArgs = appArgs
-            # handle recursive arguments in let statements
-            elif recurse is True:
-                interpedArgs = []
-                for argName, arg in zip(cloArgs, appArgs):
-                    match arg:
-                        case FnC(args, body):
-                            clo = CloV(body, env=deepcopy(env), args=args)
-                            clo.env[argName] = clo
-                            interpedArgs.append(clo)
-                        case _:
-                            interpedArgs.append(interp(arg, env, db, hints))
-            else:
-                interpedArgs = [interp(arg, env, db, hints) for arg in appArgs]
-            return interp(expr, {**cloEnv, **dict(zip(cloArgs, interpedArgs))}, db, hints)
+        case CloV(memo=memo) as clo:
+            interpedArgs = [interp(arg, env, db, ctx) for arg in appArgs] if interpArgs else appArgs
+            key = memo_key(interpedArgs) if memo is not None else None
+            if key is None:
+                return run_closure(clo, interpedArgs, db, ctx)
+            val = memo.get(key)
+            if val is None:
+                val = run_closure(clo, interpedArgs, db, ctx)
+                if len(memo) < MEMO_LIMIT:
+                    memo[key] = val
+            return val
         case PyCloV(fn, env=pyCloEnv, selfValue=selfValue):
-            interpedArgs = [interp(arg, env, db, hints) for arg in appArgs] if interpArgs else appArgs
-            return rain_wrap(fn(selfValue, pyCloEnv, db, hints, *interpedArgs), db, env)
+            interpedArgs = [interp(arg, env, db, ctx) for arg in appArgs] if interpArgs else appArgs
+            return rain_wrap(fn(selfValue, pyCloEnv, db, ctx, *interpedArgs), db, env)
         case OpV(fn):
-            interpedArgs = [interp(arg, env, db, hints) for arg in appArgs] if interpArgs else appArgs
-            return rain_wrap(fn(None, env, db, hints, *interpedArgs), db, env)
+            mask = lazy_mask(fn, len(appArgs)) if interpArgs else None
+            if mask is not None:
+                interpedArgs = [
+                    ThunkV(partial(interp, arg), env=env) if isLazy else interp(arg, env, db, ctx)
+                    for arg, isLazy in zip(appArgs, mask)
+                ]
+            else:
+                interpedArgs = [interp(arg, env, db, ctx) for arg in appArgs] if interpArgs else appArgs
+            return rain_wrap(fn(None, env, db, ctx, *interpedArgs), db, env)
         case nonCallable:
             raise Exception(f"Attempting to apply non-callable expression {nonCallable}")
 
-def interp(expr, env, db, hints=dict()):
+def lookup_id(id, env, db, ctx):
+    match env.get(id):
+        case None:
+            raise Exception(f"ID {id} is used before binding")
+        case LazyEntV(table, tablename=tablename, options=options):
+            # Slots are shared between evaluations, so the loaded entity lives in ctx
+            ent_val = ctx.resolved.get(id)
+            if ent_val is not None:
+                return ent_val
+            hint = ctx.hints.get(id)
+            if hint is None:
+                raise Exception(f"No variable supplied with name {id}")
+            ent_name = hint[1]
+            ent = db.get_entity_default_search_col(tablename, ent_name, ctx.session, options)
+            ctx.counters["entities"] += 1
+            if ent is None:
+                raise Exception(f"No {tablename} named {ent_name}")
+            ent_val = EntV(ent, table=table, tablename=tablename)
+            ctx.resolved[id] = ent_val
+            return ent_val
+        case ThunkV() as thunk:
+            return force(thunk, db, ctx)
+        case val:
+            return val
+
+def dot_access(val, id, env, db, ctx):
+    match val:
+        case EntV(ent, table=table, tablename=tablename):
+            if id not in table:
+                raise Exception(f"{id} is not a valid attribute of {tablename}: {ent}")
+            return entity_value(ent, id, db, env)
+        case PyCloV(fn, env=pyCloEnv, selfValue=selfValue):
+            val = rain_wrap(fn(selfValue, pyCloEnv, db, ctx), db, env)
+            typeclass = tcs.VALUE_MAP[val.t]
+            attr = getattr(typeclass, id, None)
+            if not callable(attr):
+                raise Exception(f"Value '{val}' of type {val.t} has no method '{id}'")
+            return PyCloV(attr, env=env, selfValue=val)
+        case ObjectV(contents):
+            attr = getattr(contents, id, None)
+            if not callable(attr):
+                raise Exception(f"Value '{val}' of type object has no method '{id}'")
+            return PyCloV(unbound(attr), env=env, selfValue=None)
+        case TableV(table):
+            mapper = sqa.inspect(table)
+            # id refers to relationship
+            if id in mapper.relationships.keys():
+                rel = getattr(table, id)
+                query = ctx.session.query(table).filter(rel.has())
+                return rain_wrap([getattr(ent, id) for ent in query], db, env)
+            # id refers to column or column property, which is queried on its own
+            if id in mapper.column_attrs.keys():
+                return ListV(pushdown.attribute_values(ctx.session, table, id, db, env))
+            # id refers to method
+            attr = getattr(tcs.TableT, id, None)
+            if not callable(attr):
+                raise Exception(f"Value '{val}' of type table has no method '{id}'")
+            return PyCloV(attr, env=env, selfValue=val)
+        case RainV():
+            typeclass = tcs.VALUE_MAP[val.t]
+            attr = getattr(typeclass, id, None)
+            if not callable(attr):
+                raise Exception(f"Value '{val}' of type {val.t} has no method '{id}'")
+            return PyCloV(attr, env=env, selfValue=val)
+        case notRainV:
+            raise Exception(f"Attempted dot access '{id}' on non-Rain value of type {type(notRainV).__name__}")
+
+# Accessors for dot accesses whose receiver type is known before evaluation.
+# They fall back to dot_access for any other value, so a wrong guess only
+# costs the check.
+
+def entity_value(ent, id, db, env):
+    # Collections that haven't been loaded are queried only once they're read
+    if id in pushdown.collections(type(ent)) and id not in vars(ent):
+        return ListV(pushdown.collection(ent, id, db, env))
+    return rain_wrap(getattr(ent, id), db, env)
+
+def entity_attr(cls, id):
+    if id in pushdown.collections(cls):
+        def access(val, env, db, ctx):
+            if type(val) is EntV and type(val.value) is cls:
+                return entity_value(val.value, id, db, env)
+            return dot_access(val, id, env, db, ctx)
+        return access
+
+    def access(val, env, db, ctx):
+        if type(val) is EntV and type(val.value) is cls:
+            return rain_wrap(getattr(val.value, id), db, env)
+        return dot_access(val, id, env, db, ctx)
+    return access
+
+def bound_method(valueType, attr, id):
+    def access(val, env, db, ctx):
+        if type(val) is valueType:
+            return PyCloV(attr, env=env, selfValue=val)
+        return dot_access(val, id, env, db, ctx)
+    return access
+
+def table_method(table, attr, id):
+    def access(val, env, db, ctx):
+        if type(val) is TableV and val.value is table:
+            return PyCloV(attr, env=env, selfValue=val)
+        return dot_access(val, id, env, db, ctx)
+    return access
+
+def object_method(contents, attr, id):
+    def access(val, env, db, ctx):
+        if type(val) is ObjectV and val.value is contents:
+            return PyCloV(unbound(attr), env=env, selfValue=None)
+        return dot_access(val, id, env, db, ctx)
+    return access
+
+def pound_access(val, id, env, db, ctx):
+    match val:
+        case ListV(QuerySeq() as rows):
+            if pushdown.unloaded(rows):
+                joined = pushdown.follow(rows, id, db, env)
+                if joined is not None:
+                    ctx.counters["sql join"] += 1
+                    return ListV(joined)
+            return pound_access(ListV(rows.rows()), id, env, db, ctx)
+        case ListV(LazyList(raw=raw)):
+            # Elements that were never wrapped are the entities themselves
+            return ListV(LazySeq(raw, ((MAP_STAGE, attr_getter(id, db, env)),)))
+        case ListV(values):
+            return ListV(add_stage(values, MAP_STAGE, attr_getter(id, db, env)))
+        case notList:
+            raise Exception(f"Attemped pound access on non-list {notList}")
+
+def attr_getter(id, db, env):
+    def get(subval):
+        return rain_wrap(getattr(subval.value if isinstance(subval, RainV) else subval, id), db, env)
+    return get
+
+def bracket_id(val):
+    if not isinstance(val, StringV):
+        raise Exception(f"Attempted bracketed access with non-string value {val}")
+    elif not re.match(r'[a-zA-Z_$][a-zA-Z_$0-9]*', val.value):
+        raise Exception(f"Invalid bracket access string '{val.value}'")
+    return val.value
+
+def compare_values(val0, val1, comp):
+    match [val0, val1]:
+        case [NumberV(n1), NumberV(n2)]: return rain_compare(n1, n2, comp)
+        case [StringV(s1), StringV(s2)]: return rain_compare(s1, s2, comp)
+        case [_, _]: return FALSE
+
+def interp(expr, env, db, ctx):
     match expr:
         case StringC(s):
-            return StringV(s)
+            return string_value(s)
         case NumC(n):
-            return NumberV(n)
-        case FnC(args, body, recurse=recurse):
-            return CloV(body, env=deepcopy(env), args=args, recurse=recurse)
+            return number_value(n)
+        case ValC(val):
+            return val
+        case FnC(args, body):
+            return CloV(body, env=env, args=args)
+        case LetC(id, valExpr, body, lazy=True):
+            return interp(body, env.bind(id, ThunkV(partial(interp, valExpr), env=env)), db, ctx)
+        case LetC(id, valExpr, body):
+            return interp(body, env.bind(id, interp(valExpr, env, db, ctx)), db, ctx)
+        case LetRecC(id, FnC(args, fnBody), body, memo=memo):
+            # The closure's own frame is filled in after it exists so it can call itself
+            frame = dict()
+            recEnv = env.extend(frame)
+            frame[id] = CloV(fnBody, env=recEnv, args=args, memo=dict() if memo else None)
+            return interp(body, recEnv, db, ctx)
         case ArrC(exprs):
-            return ListV([interp(subexpr, env, db, hints) for subexpr in exprs])
+            return ListV([interp(subexpr, env, db, ctx) for subexpr in exprs])
         case IdC(id):
-            match env.get(id):
-                case None:
-                    raise Exception(f"ID {id} is used before binding")
-                case LazyEntV(table, tablename=tablename):
-                    hint = hints.get(id)
-                    if hint is None:
-                        raise Exception(f"No variable supplied with name {id}")
-                    ent_name = hint[1]
-                    ent = db.get_entity_default_search_col(tablename, ent_name)
-                    ent_val = EntV(ent, table=table, tablename=tablename)
-                    env[id] = ent_val
-                    return ent_val
-                case val:
-                    return val
-        case DotAccessC(expr, idc):
-            match [interp(expr, env, db, hints), idc]:
-                case [EntV(ent, table=table, tablename=tablename), IdC(id)]:
-                    if id not in table:
-                        raise Exception(f"{id} is not a valid attribute of {tablename}: {ent}")
-                    return rain_wrap(getattr(ent, id), db, env)
-                case [PyCloV(fn, env=pyCloEnv, selfValue=selfValue), IdC(id)]:
-                    val = rain_wrap(fn(selfValue, pyCloEnv, db, hints), db, env)
-                    typeclass = tcs.VALUE_MAP[val.t]
-                    attr = getattr(typeclass, id, None)
-                    if not callable(attr):
-                        raise Exception(f"Value '{val}' of type {val.t} has no method '{id}'")
-                    return PyCloV(attr, env=deepcopy(env), selfValue=val)
-                case [ObjectV(contents), IdC(id)]:
-                    attr = getattr(contents, id, None)
-                    if not callable(attr):
-                        raise Exception(f"Value '{val}' of type object has no method '{id}'")
-                    return PyCloV(attr, env=deepcopy(env), selfValue=None)
-                case [TableV(table, session=session) as val, IdC(id)]:
-                    # id refers to column
-                    inspected = sqa.inspect(table)
-                    # id refers to relationship
-                    if id in sqa.inspect(table).relationships.keys():
-                        rel = getattr(table, id)
-                        query = session().query(table).filter(rel.has())
-                    # id refers to column
-                    elif id in table.__table__.c.keys():
-                        col = sqa.sql.column(id)
-                        query = session().query(table).filter(col != None)
-                    # id refers to column property
-                    elif id in [col.key for col in sqa.inspect(table).attrs]:
-                        values = []
-                        for row in session().query(table).all():
-                            attr = getattr(row, id, None)
-                            if attr is not None:
-                                values.append(attr)
-                        return values
-                    # id refers to method
-                    else:
-                        attr = getattr(tcs.TableT, id, None)
-                        if not callable(attr):
-                            raise Exception(f"Value '{val}' of type table has no method '{id}'")
-                        return PyCloV(attr, env=deepcopy(env), selfValue=val)
-
-                    values = [getattr(ent, id) for ent in query]
-                    return rain_wrap(values, db, env)
-                case [RainV() as val, IdC(id)]:
-                    typeclass = tcs.VALUE_MAP[val.t]
-                    attr = getattr(typeclass, id, None)
-                    if not callable(attr):
-                        raise Exception(f"Value '{val}' of type {val.t} has no method '{id}'")
-                    return PyCloV(attr, env=deepcopy(env), selfValue=val)
-                case _:
-                    raise Exception(f"Attempted dotaccess with non-id expr {idc}")
-        case PoundAccessC(expr, idc):
-            match [interp(expr, env, db, hints), idc]:
-                case [ListV(values), IdC(id)]:
-                    return rain_wrap([getattr(subval.value, id) for subval in values], db, env)
-                case [ListV(), notId]:
-                    raise Exception(f"Attemped pound access with non-id {notId}")
-                case [notList, _]:
-                    raise Exception(f"Attemped pound access on non-list {notList}")
+            return lookup_id(id, env, db, ctx)
+        case DotAccessC(expr, IdC(id), resolved=resolved) if resolved is not None:
+            return resolved(interp(expr, env, db, ctx), env, db, ctx)
+        case DotAccessC(expr, IdC(id)):
+            return dot_access(interp(expr, env, db, ctx), id, env, db, ctx)
+        case DotAccessC(_, idc):
+            raise Exception(f"Attempted dotaccess with non-id expr {idc}")
+        case PoundAccessC(expr, IdC(id)):
+            return pound_access(interp(expr, env, db, ctx), id, env, db, ctx)
+        case PoundAccessC(_, notId):
+            raise Exception(f"Attemped pound access with non-id {notId}")
         case BracketAccessC(expr0, expr1):
-            id = interp(expr1, env, db, hints)
-            if not isinstance(id, StringV):
-                raise Exception(f"Attempted bracketed access with non-string value {id}")
-            elif not re.match(r'[a-zA-Z_$][a-zA-Z_$0-9]*', id.value):
-                raise Exception(f"Invalid bracket access string '{id.value}'")
-            return interp(DotAccessC(expr0, IdC(id.value)), env, db, hints)
+            id = bracket_id(interp(expr1, env, db, ctx))
+            return dot_access(interp(expr0, env, db, ctx), id, env, db, ctx)
         case AppC(fnExpr, appArgs):
-            return interp_appC(interp(fnExpr, env, db, hints), appArgs, env, db, hints)
+            return interp_appC(interp(fnExpr, env, db, ctx), appArgs, env, db, ctx)
         case FStringC(fstring, exprs):
-            interped_exprs = [interp(expr, env, db, hints) for expr in exprs]
-            return StringV(fstring.format(*interped_exprs))
+            interped_exprs = [interp(expr, env, db, ctx) for expr in exprs]
+            return string_value(fstring.format(*interped_exprs))
         case CompC(expr0, comp, expr1):
-            match [interp(expr0, env, db, hints), interp(expr1, env, db, hints)]:
-                case [NumberV(n1), NumberV(n2)]: return rain_compare(n1, n2, comp)
-                case [StringV(s1), StringV(s2)]: return rain_compare(s1, s2, comp)
-                case [_, _]: return BoolV(False)
+            return compare_values(interp(expr0, env, db, ctx), interp(expr1, env, db, ctx), comp)
         case IfC(cond, l, r):
-            match interp(cond, env, db, hints):
-                case BoolV(True): return interp(l, env, db, hints)
-                case BoolV(False): return interp(r, env, db, hints)
-                case notBool: raise Exception("Non-bool if condition", notBool)
\ No newline at end of file
+            match interp(cond, env, db, ctx):
+                case BoolV(True): return interp(l, env, db, ctx)
+                case BoolV(False): return interp(r, env, db, ctx)
+                case notBool: raise Exception("Non-bool if condition", notBool)
@@ -0,0 +1,221 @@
+from functools import partial
+from rain_types import *
+from interp import (
+    interp_appC, lookup_id, dot_access, pound_access, bracket_id, compare_values, memo_key, MEMO_LIMIT
+)
+from rainmethod import lazy_mask
+
+# A stack-safe evaluator. Instead of recursing through Python frames like
+# interp, it keeps pending work on an explicit list of continuation frames.
+# Calls in tail position (the body of a closure, the chosen branch of an if,
+# the body of a let) replace the current expression without pushing a frame,
+# so tail-recursive Rain functions run in constant space. Non-tail recursion
+# grows the continuation list, which is bounded by memory rather than
+# sys.getrecursionlimit().
+#
+# Builtins that call back into Rain code (ListT.map, filter, ...) still do so
+# through interp_appC, which starts a fresh run for each callback. So do the
+# thunks passed to builtins with lazy parameters, like and and cond.
+
+# Continuation frame kinds
+LET = 0
+DOT = 1
+POUND = 2
+BRACKET_ID = 3
+BRACKET_EXPR = 4
+APP_FN = 5
+APP_ARG = 6
+ARR = 7
+FSTRING = 8
+COMP_L = 9
+COMP_R = 10
+IF = 11
+MEMO = 12
+RESOLVED_DOT = 13
+
+def closure(body, env, args, memo=None):
+    # code lets builtins re-enter the machine when they apply the closure
+    return CloV(body, env=env, args=args, code=partial(run, body), memo=memo)
+
+def run(expr, env, db, ctx):
+    konts = []
+    while True:
+        # Evaluate expr until it produces a value or defers to a subexpression.
+        # Dispatches on the exact node type, most frequent first.
+        t = type(expr)
+        if t is IdC:
+            val = lookup_id(expr.id, env, db, ctx)
+        elif t is AppC:
+            konts.append((APP_FN, expr.args, env))
+            expr = expr.fn
+            continue
+        elif t is NumC:
+            val = number_value(expr.num)
+        elif t is StringC:
+            val = string_value(expr.string)
+        elif t is ValC:
+            val = expr.val
+        elif t is IfC:
+            konts.append((IF, expr.l, expr.r, env))
+            expr = expr.cond
+            continue
+        elif t is DotAccessC or t is PoundAccessC:
+            if type(expr.id) is not IdC:
+                raise Exception(f"Attempted {'dot' if t is DotAccessC else 'pound'} access with non-id expr {expr.id}")
+            if t is DotAccessC and expr.resolved is not None:
+                konts.append((RESOLVED_DOT, expr.resolved, env))
+            else:
+                konts.append((DOT if t is DotAccessC else POUND, expr.id.id, env))
+            expr = expr.expr
+            continue
+        elif t is FnC:
+            val = closure(expr.body, env, expr.args)
+        elif t is LetC and expr.lazy:
+            env = env.bind(expr.id, ThunkV(partial(run, expr.expr), env=env))
+            expr = expr.body
+            continue
+        elif t is LetC:
+            konts.append((LET, expr.id, expr.body, env))
+            expr = expr.expr
+            continue
+        elif t is LetRecC:
+            frame = dict()
+            env = env.extend(frame)
+            frame[expr.id] = closure(expr.fn.body, env, expr.fn.args, dict() if expr.memo else None)
+            expr = expr.body
+            continue
+        elif t is FStringC:
+            if not expr.exprs:
+                val = string_value(expr.fstring.format())
+            else:
+                konts.append((FSTRING, expr.fstring, expr.exprs, [], env))
+                expr = expr.exprs[0]
+                continue
+        elif t is ArrC:
+            if not expr.vals:
+                val = ListV([])
+            else:
+                konts.append((ARR, expr.vals, [], env))
+                expr = expr.vals[0]
+                continue
+        elif t is CompC:
+            konts.append((COMP_L, expr.expr1, expr.comp, env))
+            expr = expr.expr0
+            continue
+        elif t is BracketAccessC:
+            konts.append((BRACKET_ID, expr.expr0, env))
+            expr = expr.expr1
+            continue
+        else:
+            raise Exception(f"Can't evaluate expression {expr}")
+
+        # Hand the value to pending frames until one of them needs to
+        # evaluate another expression
+        while True:
+            if not konts:
+                return val
+            kont = konts.pop()
+            kind = kont[0]
+            if kind == LET:
+                _, id, body, kenv = kont
+                expr, env = body, kenv.bind(id, val)
+                break
+            elif kind == DOT:
+                _, id, kenv = kont
+                val = dot_access(val, id, kenv, db, ctx)
+            elif kind == RESOLVED_DOT:
+                _, resolved, kenv = kont
+                val = resolved(val, kenv, db, ctx)
+            elif kind == POUND:
+                _, id, kenv = kont
+                val = pound_access(val, id, kenv, db, ctx)
+            elif kind == BRACKET_ID:
+                _, expr0, kenv = kont
+                konts.append((BRACKET_EXPR, bracket_id(val), kenv))
+                expr, env = expr0, kenv
+                break
+            elif kind == BRACKET_EXPR:
+                _, id, kenv = kont
+                val = dot_access(val, id, kenv, db, ctx)
+            elif kind == APP_FN:
+                _, appArgs, kenv = kont
+                mask = lazy_mask(val.value, len(appArgs)) if type(val) is OpV else None
+                vals = []
+                if mask is not None:
+                    add_thunks(vals, appArgs, mask, kenv)
+                if len(vals) < len(appArgs):
+                    konts.append((APP_ARG, val, appArgs, vals, mask, kenv))
+                    expr, env = appArgs[len(vals)], kenv
+                    break
+                expr, env, val = call(val, vals, konts, kenv, db, ctx)
+                if expr is not None:
+                    break
+            elif kind == APP_ARG:
+                _, fn, appArgs, vals, mask, kenv = kont
+                vals.append(val)
+                if mask is not None:
+                    add_thunks(vals, appArgs, mask, kenv)
+                if len(vals) < len(appArgs):
+                    konts.append(kont)
+                    expr, env = appArgs[len(vals)], kenv
+                    break
+                expr, env, val = call(fn, vals, konts, kenv, db, ctx)
+                if expr is not None:
+                    break
+            elif kind == ARR:
+                _, exprs, vals, kenv = kont
+                vals.append(val)
+                if len(vals) < len(exprs):
+                    konts.append(kont)
+                    expr, env = exprs[len(vals)], kenv
+                    break
+                val = ListV(vals)
+            elif kind == FSTRING:
+                _, fstring, exprs, vals, kenv = kont
+                vals.append(val)
+                if len(vals) < len(exprs):
+                    konts.append(kont)
+                    expr, env = exprs[len(vals)], kenv
+                    break
+                val = string_value(fstring.format(*vals))
+            elif kind == COMP_L:
+                _, expr1, comp, kenv = kont
+                konts.append((COMP_R, val, comp))
+                expr, env = expr1, kenv
+                break
+            elif kind == COMP_R:
+                _, val0, comp = kont
+                val = compare_values(val0, val, comp)
+            elif kind == IF:
+                _, l, r, kenv = kont
+                match val:
+                    case BoolV(True): expr = l
+                    case BoolV(False): expr = r
+                    case notBool: raise Exception("Non-bool if condition", notBool)
+                env = kenv
+                break
+            elif kind == MEMO:
+                _, memo, key = kont
+                if len(memo) < MEMO_LIMIT:
+                    memo[key] = val
+
+def add_thunks(vals, appArgs, mask, env):
+    # Passes the lazy arguments that come next unevaluated
+    while len(vals) < len(appArgs) and mask[len(vals)]:
+        vals.append(ThunkV(partial(run, appArgs[len(vals)]), env=env))
+
+def call(fn, vals, konts, env, db, ctx):
+    # Returns (body, env, None) when a Rain closure should continue in the
+    # machine, as a tail call unless its result has to be memoized, or
+    # (None, None, value) when the result is already known
+    if type(fn) is not CloV:
+        return (None, None, interp_appC(fn, vals, env, db, ctx, False))
+    if len(fn.args) != len(vals):
+        raise Exception(f"Invalid number of arguments for fn {fn.value}")
+    key = memo_key(vals) if fn.memo is not None else None
+    if key is not None:
+        val = fn.memo.get(key)
+        if val is not None:
+            return (None, None, val)
+        konts.append((MEMO, fn.memo, key))
+    return (fn.value, fn.env.extend(dict(zip(fn.args, vals))), None)
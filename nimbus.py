@@ -288,55 +288,8 @@ if __name__=="__main__":
             }
         }
     )
-    oracle = Oracle(db)
-    oracle.add_qa("What is {professor}'s email?", "`{professor0.name}'s email is {professor0.email}`")
-    oracle.add_qa("What is {professor}'s phone number?", "`{professor0.name}'s phone number is {professor0.phone_number}`")
-    oracle.add_qa("What type of course is {course}?", "`{course0.title} is a {course0.type}`")
-    oracle.add_qa(
-        "How many sections of {course} does {professor} teach?",
-        "let secs = (professor0.teaches.filter (fn (sec) -> (eq? sec.course.name course0.name))) in "
-        "(if (eq? (secs.length) 0)"
-            "`{professor0.name} does not teach any sections of {course0.title}`"
-            "`{professor0.name} teaches {(secs.length)} sections of {course0.title}`)"
-    )
-    oracle.add_qa(
-        "What courses are {professor} teaching?",
-        'let course_names = (professor0.teaches#course#name.dedup) in '
-        '(if (course_names.empty)'
-            '`{professor0.name} is not teaching any courses this quarter`'
-            '`{professor0.name} is teaching {(course_names.grammatical_join "and")}`)'
-    )
-    what_sections = (
-        'let prof_sections = (professor0.teaches.filter (fn (sec) -> (eq? sec.course.name course0.name))) in '
-        '(if (prof_sections.empty)'
-            '`{professor0.name} does not teach any sections of {course0.name}`'
-            '`{professor0.name} teaches sections {(prof_sections#section_number.gjoin "and")} of {course0.name}`)'
-    )
-    oracle.add_qa("What sections of {course} does {professor} teach?", what_sections)
-    oracle.add_qa("what sections of {course} is {professor} teaching?", what_sections)
-    oracle.add_qa(
-        "what is the earliest section of {course} taught by {professor}?",
-        'let prof_sections = (professor0.teaches.filter (fn (sec) -> (eq? sec.course.name course0.name))) in '
-        'let times = (prof_sections#start_time.map '
-            '(fn (st) -> (+ (if (eq? (st.find "PM") -1) 0 12) (num (st.slice 0 (st.find ":")))))) in '
-        'let earliest = (prof_sections.at (times.find (times.min))) in '
-        '(if (times.empty)'
-            '`{professor0.name} does not teach any sections of {course0.name}`'
-            '`{professor0.name}\'s earliest section of {earliest.course.name} is {earliest.title} which starts at {earliest.start_time}`)'
-    )
-    oracle.add_qa(
-        "What professors teach {course}?",
-        'let profs_teaching = (course0.sections#instructor#name.dedup) in '
-        '(if (profs_teaching.empty) '
-            '`No professors are teaching {course0.title} this quarter`'
-            '`{(profs_teaching.gjoin "and")} are teaching {course0.title} this quarter`)'
-    )
-    oracle.add_qa(
-        "What course is taught by the most professors?",
-
-        'let max_course = (courses.max_by (fn (course) -> (course.sections#instructor#name.dedup.length))) in '
-        'let n_instructors = (max_course.sections#instructor#name.dedup.length) in '
-        '`The course being taught by the most professors this quarter is {max_course.name} with {n_instructors} instructors.`'
-    )
+    oracle = Oracle(db, cache_path=os.path.join(PROJECT_DIR, "templates.cache"))
+    oracle.load_templates(os.path.join(PROJECT_DIR, "templates.json"))
+    oracle.save_cache()
     nimbus = Nimbus("model.txt", oracle)
     nimbus.repl()
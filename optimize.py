@@ -0,0 +1,395 @@
+from dataclasses import replace
+from itertools import count
+from rain_types import *
+from interp import interp
+
+# Compile-time passes over ExprC trees. Passes never modify the tree they are
+# given, since parsed trees are shared between templates and the template cache.
+
+def map_children(expr, fn):
+    # Rebuilds expr with fn applied to each of its direct subexpressions
+    match expr:
+        case FnC(args, body):
+            return replace(expr, body=fn(body))
+        case LetC(_, valExpr, body):
+            return replace(expr, expr=fn(valExpr), body=fn(body))
+        case LetRecC(_, fnExpr, body):
+            return replace(expr, fn=fn(fnExpr), body=fn(body))
+        case ArrC(exprs):
+            return replace(expr, vals=[fn(subexpr) for subexpr in exprs])
+        case DotAccessC(subexpr, _) | PoundAccessC(subexpr, _):
+            return replace(expr, expr=fn(subexpr))
+        case BracketAccessC(expr0, expr1):
+            return replace(expr, expr0=fn(expr0), expr1=fn(expr1))
+        case AppC(fnExpr, appArgs):
+            return replace(expr, fn=fn(fnExpr), args=[fn(arg) for arg in appArgs])
+        case FStringC(_, exprs):
+            return replace(expr, exprs=[fn(subexpr) for subexpr in exprs])
+        case CompC(expr0, _, expr1):
+            return replace(expr, expr0=fn(expr0), expr1=fn(expr1))
+        case IfC(cond, l, r):
+            return replace(expr, cond=fn(cond), l=fn(l), r=fn(r))
+        case _:
+            return expr
+
+def children(expr):
+    match expr:
+        case FnC(_, body):
+            return [body]
+        case LetC(_, expr0, expr1) | LetRecC(_, expr0, expr1) | BracketAccessC(expr0, expr1) | CompC(expr0, _, expr1):
+            return [expr0, expr1]
+        case ArrC(exprs) | FStringC(_, exprs):
+            return exprs
+        case DotAccessC(subexpr, _) | PoundAccessC(subexpr, _):
+            return [subexpr]
+        case AppC(fnExpr, appArgs):
+            return [fnExpr, *appArgs]
+        case IfC(cond, l, r):
+            return [cond, l, r]
+        case _:
+            return []
+
+#
+#
+# Purity
+#
+#
+
+# Builtins from DEFAULT_ENV that never touch the database
+PURE_BUILTINS = {
+    "true", "false", "none", "List", "String",
+    "+", "-", "*", "/", "mod", "exp",
+    "eq?", "equal?", "ne?", "not-equal?", "gt?", "lt?", "le?",
+    "not", "and", "or", "xor", "nand", "nor", "xnor", "num", "str", "cond", "case"
+}
+
+# Operators whose result a constant left operand decides, by operand
+SHORT_CIRCUITS = {
+    ("and", False): FALSE,
+    ("or", True): TRUE,
+    ("nand", False): TRUE,
+    ("nor", True): FALSE
+}
+
+# StringT and ListT methods. Dot access to anything else may be an entity
+# attribute or relationship, and # access always is.
+PURE_METHODS = {
+    "replicate", "startswith", "endswith", "contains", "lower", "upper", "slice", "spell",
+    "find", "map", "filter", "first", "rest", "empty", "grammatical_join", "gjoin", "length",
+    "foldl", "dedup", "max", "min", "sort", "max_by", "min_by", "sort_by", "at",
+    "sum", "mean", "count_where", "argmax", "argmin", "top_k", "bottom_k", "take", "take_while"
+}
+
+def is_pure(expr, local, builtins=PURE_BUILTINS):
+    # local holds the names bound inside the function being checked. Any other
+    # free variable could be a slot entity or a table, so it makes expr impure.
+    match expr:
+        case StringC() | NumC() | ValC():
+            return True
+        case IdC(id):
+            return id in local or id in builtins
+        case FnC(args, body):
+            return is_pure(body, local | set(args), builtins)
+        case LetC(id, valExpr, body):
+            return is_pure(valExpr, local, builtins) and is_pure(body, local | {id}, builtins)
+        case LetRecC(id, FnC(args, fnBody), body):
+            return is_pure(fnBody, local | {id, *args}, builtins) and is_pure(body, local | {id}, builtins)
+        case DotAccessC(subexpr, IdC(id)):
+            return id in PURE_METHODS and is_pure(subexpr, local, builtins)
+        case PoundAccessC() | BracketAccessC():
+            return False
+        case AppC(fnExpr, appArgs):
+            return is_pure(fnExpr, local, builtins) and all(is_pure(arg, local, builtins) for arg in appArgs)
+        case ArrC(exprs) | FStringC(_, exprs):
+            return all(is_pure(subexpr, local, builtins) for subexpr in exprs)
+        case CompC(expr0, _, expr1):
+            return is_pure(expr0, local, builtins) and is_pure(expr1, local, builtins)
+        case IfC(cond, l, r):
+            return all(is_pure(subexpr, local, builtins) for subexpr in [cond, l, r])
+        case _:
+            return False
+
+def contains_letrec(expr):
+    return type(expr) is LetRecC or any(map(contains_letrec, children(expr)))
+
+def mark_memoized(expr):
+    # Flags recursive let-bound functions whose bodies are pure so that
+    # applications of them are memoized for the rest of the evaluation
+    expr = map_children(expr, mark_memoized)
+    match expr:
+        case LetRecC(id, FnC(args, fnBody), _) if is_pure(fnBody, {id, *args}):
+            return replace(expr, memo=True)
+        case _:
+            return expr
+
+#
+#
+# Constant folding
+#
+#
+
+def literal_value(expr):
+    match expr:
+        case StringC(s):
+            return string_value(s)
+        case NumC(n):
+            return number_value(n)
+        case ValC(val):
+            return val
+        case _:
+            return None
+
+def is_data(val):
+    # Only plain values are folded. Closures and tables stay runtime values.
+    match val:
+        case NumberV() | StringV() | BoolV() | NoneV():
+            return True
+        case ListV(vals):
+            return isinstance(vals, LIST_TYPES) and all(is_data(v) for v in vals)
+        case _:
+            return False
+
+def fold_constants(expr, env, folds, bound=frozenset()):
+    # Replaces subexpressions that only depend on literals and pure builtins
+    # with their values, evaluated once in env. bound holds the names bound
+    # around expr, which may shadow builtins. Each fold is appended to folds
+    # as a (before, after) pair of expressions.
+    if type(expr) not in (StringC, NumC, ValC, FnC) and is_pure(expr, set(), PURE_BUILTINS - bound) \
+            and not contains_letrec(expr):
+        try:
+            val = interp(expr, env, None, EvalContext(dict()))
+            # Reads lazy lists, which may raise too
+            data = is_data(val)
+        except Exception:
+            # Left for evaluation, so the error is raised when the template is answered
+            data = False
+        if data:
+            if type(expr) is not IdC:
+                folds.append((expr, ValC(val)))
+            return ValC(val)
+
+    fold = lambda subexpr: fold_constants(subexpr, env, folds, bound)
+    match expr:
+        case FnC(args, body):
+            return replace(expr, body=fold_constants(body, env, folds, bound | set(args)))
+        case LetC(id, valExpr, body):
+            return replace(expr, expr=fold(valExpr), body=fold_constants(body, env, folds, bound | {id}))
+        case LetRecC(id, FnC(args, fnBody) as fnExpr, body):
+            fnBody = fold_constants(fnBody, env, folds, bound | {id, *args})
+            body = fold_constants(body, env, folds, bound | {id})
+            return replace(expr, fn=replace(fnExpr, body=fnBody), body=body)
+    expr = map_children(expr, fold)
+
+    match expr:
+        case IfC(ValC(BoolV(True)), l, _):
+            folds.append((expr, l))
+            return l
+        case IfC(ValC(BoolV(False)), _, r):
+            folds.append((expr, r))
+            return r
+        case AppC(IdC(op), [ValC(BoolV(l)), _]) if (op, l) in SHORT_CIRCUITS and op not in bound:
+            folded = ValC(SHORT_CIRCUITS[(op, l)])
+            folds.append((expr, folded))
+            return folded
+        case FStringC(fstring, exprs) if any(literal_value(subexpr) is not None for subexpr in exprs):
+            # Splice constant parts into the format string
+            parts = []
+            dynamic = []
+            for subexpr in exprs:
+                val = literal_value(subexpr)
+                if val is None:
+                    parts.append(f"{{{len(dynamic)}}}")
+                    dynamic.append(subexpr)
+                else:
+                    parts.append(str(val).replace("{", "{{").replace("}", "}}"))
+            folded = FStringC(fstring.format(*parts), dynamic)
+            folds.append((expr, folded))
+            return folded
+        case _:
+            return expr
+
+#
+#
+# Common subexpressions
+#
+#
+
+def node_facts(expr, facts):
+    # The free variables of expr, whether it reads an entity, and its repr,
+    # worked out once per node for the whole pass. facts is keyed by id(expr)
+    # and holds on to expr, so the id can't be reused by a node built later.
+    entry = facts.get(id(expr))
+    if entry is not None:
+        return entry
+    subfacts = [node_facts(subexpr, facts) for subexpr in children(expr)]
+    match expr:
+        case IdC(name):
+            frees = {name}
+        case FnC(args, _):
+            frees = subfacts[0][1] - set(args)
+        case LetC(name, _, _):
+            frees = subfacts[0][1] | (subfacts[1][1] - {name})
+        case LetRecC(name, _, _):
+            frees = (subfacts[0][1] | subfacts[1][1]) - {name}
+        case _:
+            frees = set().union(*(sub[1] for sub in subfacts))
+    access = type(expr) in (DotAccessC, PoundAccessC) or any(sub[2] for sub in subfacts)
+    entry = facts[id(expr)] = (expr, frees, access, repr(expr))
+    return entry
+
+def worth_sharing(expr, facts):
+    # Entity attributes, relationships and method calls are what is expensive
+    # to evaluate twice. Lambdas and unapplied string and list methods stay
+    # where they are.
+    match expr:
+        case IdC() | StringC() | NumC() | ValC() | FnC():
+            return False
+        case DotAccessC(_, IdC(id)) if id in PURE_METHODS:
+            return False
+        case _:
+            return node_facts(expr, facts)[2]
+
+def count_shareable(expr, inner, in_fn, found, facts):
+    # Counts the subexpressions of a region that could be evaluated at its
+    # root, i.e. whose free variables aren't bound by anything in between.
+    # inner holds the names bound on the way down, and in_fn records whether
+    # an occurrence is inside a function, which may be applied many times.
+    # Each entry of found is [expr, occurrences, occurrences inside functions].
+    _, frees, _, key = node_facts(expr, facts)
+    if worth_sharing(expr, facts) and not (frees & inner):
+        entry = found.setdefault(key, [expr, 0, 0])
+        entry[1] += 1
+        entry[2] += int(in_fn)
+    match expr:
+        case FnC(args, body):
+            count_shareable(body, inner | set(args), True, found, facts)
+        case LetC(id, valExpr, body):
+            count_shareable(valExpr, inner, in_fn, found, facts)
+            count_shareable(body, inner | {id}, in_fn, found, facts)
+        case LetRecC(id, FnC(args, fnBody), body):
+            count_shareable(fnBody, inner | {id, *args}, True, found, facts)
+            count_shareable(body, inner | {id}, in_fn, found, facts)
+        case _:
+            for subexpr in children(expr):
+                count_shareable(subexpr, inner, in_fn, found, facts)
+
+def substitute(expr, target, temp, inner, facts):
+    if expr == target and not (node_facts(expr, facts)[1] & inner):
+        return IdC(temp)
+    sub = lambda subexpr, inner: substitute(subexpr, target, temp, inner, facts)
+    match expr:
+        case FnC(args, body):
+            return replace(expr, body=sub(body, inner | set(args)))
+        case LetC(id, valExpr, body):
+            return replace(expr, expr=sub(valExpr, inner), body=sub(body, inner | {id}))
+        case LetRecC(id, FnC(args, fnBody) as fnExpr, body):
+            fnBody = sub(fnBody, inner | {id, *args})
+            return replace(expr, fn=replace(fnExpr, body=fnBody), body=sub(body, inner | {id}))
+        case _:
+            return map_children(expr, lambda subexpr: sub(subexpr, inner))
+
+def share_region(body, temps, shared, facts):
+    # Binds each subexpression of the region that is repeated, or that sits
+    # inside a function but doesn't depend on its arguments, once at the
+    # root of the region. The bindings are lazy so that nothing is evaluated
+    # that the original template wouldn't have evaluated.
+    found = dict()
+    count_shareable(body, set(), False, found, facts)
+    while True:
+        candidates = [entry for entry in found.values() if entry[1] > 1 or entry[2] > 0]
+        if not candidates:
+            break
+        # Largest first, so a repeated chain is shared rather than its prefixes
+        target, n, n_in_fn = max(candidates, key=lambda entry: len(node_facts(entry[0], facts)[3]))
+        temp = f"%cse{next(temps)}"
+        shared.append((target, temp))
+        body = LetC(temp, target, substitute(body, target, temp, set(), facts), lazy=True)
+        # Only the counts inside target change: its n occurrences become the
+        # one binding, outside any function. Expressions around target keep
+        # their counts, which were too low to share.
+        within = dict()
+        count_shareable(target, set(), False, within, facts)
+        for key, (_, m, m_in_fn) in within.items():
+            entry = found[key]
+            entry[1] -= (n - 1) * m
+            entry[2] -= n_in_fn * m + (n - n_in_fn - 1) * m_in_fn
+    return share_within(body, temps, shared, facts)
+
+def share_within(expr, temps, shared, facts):
+    # Each function and let body is a region of its own, for subexpressions
+    # that use its arguments or binding
+    region = lambda body: share_region(body, temps, shared, facts)
+    match expr:
+        case FnC(args, body):
+            return replace(expr, body=region(body))
+        case LetC(id, valExpr, body):
+            return replace(expr, expr=share_within(valExpr, temps, shared, facts), body=region(body))
+        case LetRecC(id, FnC(args, fnBody) as fnExpr, body):
+            return replace(expr, fn=replace(fnExpr, body=region(fnBody)), body=region(body))
+        case _:
+            return map_children(expr, lambda subexpr: share_within(subexpr, temps, shared, facts))
+
+def share_subexprs(ast, shared=None):
+    # Temporaries are named %cseN, which can't clash with template ids.
+    # Each (expr, name) pair is appended to shared when it is given.
+    return share_region(ast, count(), shared if shared is not None else [], dict())
+
+def inline_shared(expr):
+    # Undoes share_subexprs, putting each %cse temporary's expression back
+    # where it was used, e.g. for pushdown.py to see the column paths a
+    # function reads
+    match expr:
+        case LetC(id, valExpr, body, lazy=True) if id.startswith("%cse"):
+            return inline_shared(replace_id(body, id, valExpr))
+        case _:
+            return map_children(expr, inline_shared)
+
+def replace_id(expr, id, val):
+    # Temporaries are never rebound, so there is no shadowing to respect
+    if expr == IdC(id):
+        return val
+    return map_children(expr, lambda subexpr: replace_id(subexpr, id, val))
+
+def unparse(expr):
+    # Template source for expr, for reports
+    match expr:
+        case StringC(s):
+            return f'"{s}"'
+        case NumC(n):
+            return str(n)
+        case ValC(StringV(s)):
+            return f'"{s}"'
+        case ValC(val):
+            return str(val)
+        case IdC(id):
+            return id
+        case FnC(args, body):
+            return f"(fn ({' '.join(args)}) -> {unparse(body)})"
+        case LetC(id, valExpr, body) | LetRecC(id, valExpr, body):
+            return f"let {id} = {unparse(valExpr)} in {unparse(body)}"
+        case ArrC(exprs):
+            return f"[{' '.join(map(unparse, exprs))}]"
+        case DotAccessC(subexpr, IdC(id)):
+            return f"{unparse(subexpr)}.{id}"
+        case PoundAccessC(subexpr, IdC(id)):
+            return f"{unparse(subexpr)}#{id}"
+        case BracketAccessC(expr0, expr1):
+            return f"{unparse(expr0)}[{unparse(expr1)}]"
+        case AppC(fnExpr, appArgs):
+            return f"({' '.join(map(unparse, [fnExpr, *appArgs]))})"
+        case FStringC(fstring, exprs):
+            return "`" + fstring.format(*[f"{{{unparse(subexpr)}}}" for subexpr in exprs]) + "`"
+        case CompC(expr0, comp, expr1):
+            return f"{unparse(expr0)} {comp} {unparse(expr1)}"
+        case IfC(cond, l, r):
+            return f"(if {unparse(cond)} {unparse(l)} {unparse(r)})"
+        case _:
+            return repr(expr)
+
+def optimize(ast, env, memoize=True, folds=None, shared=None):
+    # env supplies the builtins for constant folding. Folds are appended to
+    # folds when it is given.
+    ast = fold_constants(ast, env, folds if folds is not None else [])
+    if memoize:
+        ast = mark_memoized(ast)
+    return share_subexprs(ast, shared)
@@ -1,54 +1,109 @@
-from pprint import pprint
-from sly import Parser
+from parsetables import PrecomputedParser
 from sqlalchemy import table
 from lex import RainValueLexer2
-from entities.Club import ClubEnt
-from entities.Professor import ProfessorEnt
-from entities.Department import DepartmentEnt
-from entities.Course import CourseEnt
-from entities.Location import LocationEnt
-from entities.Section import SectionEnt
-from db import Database
-from qa import generate_answer_function
+from qa import AnswerTemplate, get_slot_schema
+from template_cache import TemplateCache
+from registry import load_registry, parse_answer_sources, check_parsed
+from optimize import optimize
 from rain_types import *
-from interp import interp
 import typeclasses as tcs
-import weakref
 import rainmethod as rmethod
+from types import MappingProxyType
 
 class Oracle:
-    def __init__(self, db):
+    # Templates are registered up front and only read by answer, which keeps
+    # everything it loads in a per-call EvalContext. So once registration is
+    # done, one Oracle can answer from many threads at once.
+    def __init__(self, db, cache_path=None, engine="compiled", fallback="stack"):
         self.qa = dict()
         self.db = db
         self.lexer = RainValueLexer2()
         self.parser = RainValueParser2(db)
-
-    def add_qa(self, qformat, aformat):
-        self.qa[qformat.lower()] = generate_answer_function(
-            self.parser,
-            self.lexer,
-            qformat,
-            aformat
-        )
+        self.env = Scope(MappingProxyType(RainValueParser2.make_env(db)))
+        # Compiled templates keyed by answer source and slot schema, so synonym
+        # question formats share a single parse
+        self.templates = dict()
+        self.cache = TemplateCache(cache_path, GRAMMAR_VERSION) if cache_path else None
+        self.engine = engine
+        # See AnswerTemplate.fallback
+        self.fallback = fallback
+
+    def add_qa(self, qformat, aformat, memoize=True):
+        self.qa[qformat.lower()] = self.compile_template(qformat, aformat, memoize=memoize)
+
+    def load_templates(self, path, workers=None):
+        entries = load_registry(path)
+        sources = { entry.answer for entry in entries }
+        if self.cache is not None:
+            sources = { source for source in sources if self.cache.get(source) is None }
+        parsed = parse_answer_sources(sources, workers)
+        check_parsed([entry for entry in entries if entry.answer in parsed], parsed)
+
+        for source, (ast, _) in parsed.items():
+            if self.cache is not None:
+                self.cache.put(source, ast)
+        for entry in entries:
+            ast = parsed[entry.answer][0] if entry.answer in parsed else None
+            for qformat in entry.questions:
+                try:
+                    self.qa[qformat.lower()] = self.compile_template(qformat, entry.answer, ast, entry.memoize)
+                except Exception as e:
+                    raise Exception(f"{entry.location} ({qformat!r}): {e}") from e
+
+    def compile_template(self, qformat, aformat, ast=None, memoize=True):
+        slots = get_slot_schema(qformat)
+        key = (aformat, tuple(sorted(slots.items())), memoize)
+        template = self.templates.get(key)
+        if template is None:
+            ast = ast if ast is not None else self.parse_answer(aformat)
+            folds = []
+            ast = optimize(ast, self.env, memoize, folds)
+            template = AnswerTemplate(aformat, ast, self.env, slots, self.db, self.engine, folds, self.fallback)
+            self.templates[key] = template
+        return template
+
+    def parse_answer(self, aformat):
+        if self.cache is not None:
+            ast = self.cache.get(aformat)
+            if ast is not None:
+                return ast
+        ast = self.parser.parse(self.lexer.tokenize(aformat))
+        if self.cache is not None:
+            self.cache.put(aformat, ast)
+        return ast
+
+    def save_cache(self):
+        if self.cache is not None:
+            self.cache.save()
     
-    def answer(self, qformat, **kwargs):
-        afunction = self.qa.get(qformat)
-        if afunction is None:
+    def template(self, qformat):
+        template = self.qa.get(qformat)
+        if template is None:
             raise Exception(f"Answer format for question format '{qformat}' not found")
-        parsed = afunction(**kwargs)
-        pprint(parsed)
-        print()
-        return interp(parsed, self.parser.env, self.parser.db, self.parser.hints)
+        return template
+
+    def answer(self, qformat, **kwargs):
+        return self.template(qformat).evaluate(self.db, **kwargs)
+
+    def answer_with_counters(self, qformat, **kwargs):
+        # The answer and the database work it took, see EvalContext.counters
+        template = self.template(qformat)
+        ctx = template.context(self.db, **kwargs)
+        return template.evaluate_in(ctx, self.db), ctx.counters
 
 # Silence the linter
 _ = None
 debugfile = None
 
+# Part of the template cache key. Bump whenever the grammar or the shape of the
+# ExprC trees it produces changes.
+GRAMMAR_VERSION = 3
+
 
 DEFAULT_ENV = {
-    "true": BoolV(True),
-    "false": BoolV(False),
-    "none": NoneV(),
+    "true": TRUE,
+    "false": FALSE,
+    "none": NONE,
     "List": ObjectV(tcs.ListT),
     "Table": ObjectV(tcs.TableT),
     "String": ObjectV(tcs.StringT),
@@ -73,34 +128,32 @@ DEFAULT_ENV = {
     "nor": OpV(rmethod.RAIN_NOR),
     "xnor": OpV(rmethod.RAIN_XNOR),
     "num": OpV(rmethod.RAIN_TO_NUM),
-    "str": OpV(rmethod.RAIN_TO_STR)
+    "str": OpV(rmethod.RAIN_TO_STR),
+    "cond": OpV(rmethod.RAIN_COND),
+    "case": OpV(rmethod.RAIN_CASE)
 }
 
-class RainValueParser2(Parser):
+class RainValueParser2(PrecomputedParser):
     tokens = RainValueLexer2.tokens
+    # Regenerate with `python parsetables.py` after changing the grammar
+    tables_module = "rain_parsetab"
 
-    def __init__(self, db):
-        self.env = RainValueParser2.make_env(db)
-        self.hints = dict()
+    def __init__(self, db=None):
+        # Parsing doesn't need the database, so registry workers build parsers without one
         self.db = db
 
+    def error(self, token):
+        if token is None:
+            raise Exception("Unexpected end of template")
+        raise Exception(f"Unexpected {token.type} {token.value!r} at index {token.index}")
+
     @staticmethod
     def make_env(db):
         env = dict()
         for table, config in db.entity_config.items():
-            env[config.get("name_remapping") or table.__tablename__] = TableV(table, session=weakref.ref(db.session))
+            env[config.get("name_remapping") or table.__tablename__] = TableV(table)
         return { **DEFAULT_ENV, **env }
 
-    def parse_with_hints(self, toks, hints):
-        self.hints = hints
-        env_from_hints = dict()
-        for k, v in hints.items():
-            vtype = v[0]
-            env_from_hints[k] = LazyEntV(self.db.type_map[self.db.entity_types[vtype]], tablename=vtype)
-        # env_from_hints = {k : LazyEntV(self.db.type_map[self.db.entity_types[v[0]]], tablename=v[0]) for k, v in hints.items()}
-        self.env = { **RainValueParser2.make_env(self.db), **env_from_hints }
-        return self.parse(toks)
-
     @_('INT', 'FLOAT')
     def expr(val, p):
         return NumC(p[0])
@@ -112,10 +165,9 @@ class RainValueParser2(Parser):
     # Remove shift/reduce conflict here (ends in expr)
     @_("LET ID '=' expr IN expr")
     def expr(val, p):
-        return AppC(
-            FnC([p.ID], p.expr1, recurse=True),
-            [p.expr0]
-        )
+        if isinstance(p.expr0, FnC):
+            return LetRecC(p.ID, p.expr0, p.expr1)
+        return LetC(p.ID, p.expr0, p.expr1)
     
     @_("FSTRING_START")
     def fstring_frag(val, p):
@@ -203,65 +255,3 @@ class RainValueParser2(Parser):
     @_('ID')
     def expr(val, p):
         return IdC(p.ID)
-
-
-def new_parser_test():
-    DB_FILE = "calpoly.db"
-    db = Database(
-        DB_FILE,
-        [
-            ProfessorEnt,
-            ClubEnt,
-            DepartmentEnt,
-            LocationEnt,
-            CourseEnt,
-            SectionEnt
-        ],
-        {
-            ProfessorEnt: "alias",
-            ClubEnt: "name",
-            DepartmentEnt: "name",
-            LocationEnt: "id",
-            CourseEnt: "title",
-            SectionEnt: "title"
-
-        }
-    )
-    oracle = Oracle(db)
-    oracle.add_qa(
-        "What is {prof:professor}'s email?",
-        "`${prof.name}'s email is ${prof.email}`"
-    )
-
-    oracle.add_qa(
-        "fntest",
-        'let fib = (fn (n) -> (if (le? n 1) n (+ (fib (- n 1)) (fib (- n 2))))) in'
-        '(fib 7)'
-    )
-
-    oracle.add_qa(
-        "fntest2",
-        '(List.at ([2 1 3].sort_by (fn (x) -> (* x -1))) 0)'
-    )
-
-    oracle.add_qa(
-        "Does {prof:professor} advise any clubs?",
-        '(if (prof.advises.empty)'
-            '`No, {prof.name} does not advise any clubs`'
-            '`Yes, {prof.name} advises {(List.gjoin (prof.advises.map (fn (club) -> club.name)) "and")}`)'
-    )
-
-    oracle.add_qa(
-        "What classes does {prof:professor} teach?",
-        '(if (prof.teaches.empty)'
-            '`{prof.name} does not teach any courses this quarter`'
-            '`{prof.name} teaches {(prof.teaches#course#name.dedup.gjoin "and")}`)'
-    )
-
-    print(oracle.answer("fntest2"))
-    # print(oracle.answer("What classes does {prof:professor} teach?", prof="husmith"))
-    # print(oracle.answer("Does {prof:professor} advise any clubs?", prof="sding01"))
-
-
-if __name__=="__main__":
-    new_parser_test()
\ No newline at end of file
@@ -0,0 +1,94 @@
+import hashlib
+import importlib
+import os
+import sys
+from pprint import pformat
+from sly import Parser
+from sly.yacc import Grammar, LRTable, _collect_grammar_rules
+
+
+class LoadedLRTable:
+    # The parts of sly.yacc.LRTable that Parser.parse reads at runtime
+    def __init__(self, lr_action, lr_goto, defaulted_states):
+        self.lr_action = lr_action
+        self.lr_goto = lr_goto
+        self.defaulted_states = defaulted_states
+
+
+class PrecomputedParser(Parser):
+    # A sly Parser that loads its LALR tables from a module generated by
+    # write_tables() instead of analysing the grammar at class creation.
+    # Falls back to sly's own build when the module is missing, stale, or
+    # RAIN_PARSETAB=0 is set.
+    tables_module = None
+
+    @classmethod
+    def _build(cls, definitions):
+        if vars(cls).get("_build", False):
+            return
+        cls._rules = [(name, value) for name, value in definitions if callable(value) and hasattr(value, "rules")]
+        if cls.tables_module and os.environ.get("RAIN_PARSETAB", "1") != "0" and cls._load_tables():
+            return
+        super()._build(definitions)
+
+    @classmethod
+    def _make_grammar(cls):
+        grammar = Grammar(cls.tokens)
+        for level, (assoc, *terms) in enumerate(getattr(cls, "precedence", []), start=1):
+            for term in terms:
+                grammar.set_precedence(term, assoc, level)
+        for _, func in cls._rules:
+            for pfunc, rulefile, ruleline, prodname, syms in _collect_grammar_rules(func):
+                grammar.add_production(prodname, syms, pfunc, rulefile, ruleline)
+        grammar.set_start(getattr(cls, "start", None))
+        return grammar
+
+    @classmethod
+    def _load_tables(cls):
+        try:
+            tables = importlib.import_module(cls.tables_module)
+        except ImportError:
+            return False
+        grammar = cls._make_grammar()
+        if tables.signature != grammar_signature(grammar):
+            cls.log.warning("Parse tables in %s are out of date, rebuilding from the grammar", cls.tables_module)
+            return False
+        cls._grammar = grammar
+        cls._lrtable = LoadedLRTable(tables.lr_action, tables.lr_goto, tables.defaulted_states)
+        return True
+
+
+def grammar_signature(grammar):
+    # Covers everything the tables are built from: the start symbol, the
+    # productions with their precedence, and the precedence of terminals
+    rules = [f"{p.name} -> {' '.join(p.prod)} {p.prec}" for p in grammar.Productions]
+    precedence = [f"{term} {assoc} {level}" for term, (assoc, level) in sorted(grammar.Precedence.items())]
+    signature = "\n".join([f"start {grammar.Start}", *rules, *precedence])
+    return hashlib.sha256(signature.encode()).hexdigest()
+
+
+def write_tables(parser_cls, path, debugfile=None):
+    grammar = parser_cls._make_grammar()
+    lrtable = LRTable(grammar)
+    with open(path, "w") as f:
+        f.write(f"# Generated by parsetables.py for {parser_cls.__qualname__}. Do not edit.\n")
+        f.write(f"signature = {grammar_signature(grammar)!r}\n")
+        f.write(f"lr_action = {pformat(lrtable.lr_action)}\n")
+        f.write(f"lr_goto = {pformat(lrtable.lr_goto)}\n")
+        f.write(f"defaulted_states = {pformat(lrtable.defaulted_states)}\n")
+    if debugfile:
+        with open(debugfile, "w") as f:
+            f.write(str(grammar))
+            f.write("\n")
+            f.write(str(lrtable))
+
+
+if __name__=="__main__":
+    # python parsetables.py [--debug]
+    os.environ["RAIN_PARSETAB"] = "0"
+    from parse import RainValueParser2
+    write_tables(
+        RainValueParser2,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{RainValueParser2.tables_module}.py"),
+        debugfile="parser.out" if "--debug" in sys.argv else None
+    )
@@ -0,0 +1,415 @@
+import operator
+from functools import cache
+import sqlalchemy as sqa
+from sqlalchemy.orm import MANYTOONE, object_session, with_parent, joinedload, selectinload
+from sqlalchemy.sql.visitors import replacement_traverse
+import rain_types as rt
+import rainmethod as rmethod
+import interp
+
+# Translates the Rain functions passed to TableT.filter and TableT.map into
+# SQL, so the database selects the rows instead of Python. Only functions
+# whose SQL gives the same answer are translated; anything else is None and
+# runs in Python as before. Which path was taken is counted in ctx.counters.
+#
+# Rows queried this way, and relationship collections that haven't been
+# loaded, are rain_types.QuerySeqs. # chains on them become joins, see follow,
+# and aggregates over them are asked of the database too.
+#
+# Rain's comparisons are two-valued while SQL's are three-valued, so every
+# comparison is written to be true or false even for NULL columns:
+#   - eq? and ne? compare with Python's ==, so NULL equals none and nothing
+#     else, like IS and IS NOT
+#   - CompC comparisons are false unless both sides are numbers or both are
+#     strings, so NULL columns never match
+#   - lt?, gt?, le? and ge? raise on NULL in Python. Like ORDER BY in
+#     TableT.top_k, those rows are skipped instead. So are rows whose path
+#     goes through a missing relationship, where Python would raise too.
+
+ORDERINGS = {
+    rmethod.RAIN_GREATER_THAN: operator.gt,
+    rmethod.RAIN_GREATER_TO_OR_EQUAL: operator.ge,
+    rmethod.RAIN_LESS_THAN: operator.lt,
+    rmethod.RAIN_LESS_TO_OR_EQUAL: operator.le,
+}
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    "<=": operator.le,
+    ">": operator.gt,
+    "<": operator.lt
+}
+
+LITERALS = (rt.NumberV, rt.StringV, rt.BoolV, rt.NoneV)
+
+def not_translatable(env, db, ctx):
+    raise Exception("Row argument used outside a column path")
+
+# Bound to the row argument while arguments to comparisons are evaluated, so
+# anything that depends on the row fails instead of being computed once
+ROW = rt.ThunkV(not_translatable, env=None)
+
+class Path:
+    # s.a.b.c: the many-to-one relationships a and b, then column or
+    # relationship c, of row s
+    __slots__ = ("rels", "attr", "t")
+
+    def __init__(self, rels, attr, t):
+        self.rels = rels
+        self.attr = attr
+        self.t = t
+
+    def where(self, clause):
+        for rel in reversed(self.rels):
+            clause = rel.has(clause)
+        return clause
+
+class Translator:
+    def __init__(self, fn, table, db, ctx):
+        from optimize import inline_shared
+        # Paths read twice, like s.days in a range check, were bound to
+        # temporaries by optimize.share_subexprs
+        self.body = inline_shared(fn.value)
+        self.arg = fn.args[0]
+        self.env = fn.env.bind(self.arg, ROW)
+        self.table = table
+        self.db = db
+        self.ctx = ctx
+
+    def predicate(self, expr):
+        clause = self.clause(expr)
+        if clause is not None:
+            return clause
+        match self.value(expr):
+            case rt.BoolV(True): return sqa.true()
+            case rt.BoolV(False): return sqa.false()
+        return None
+
+    def clause(self, expr):
+        match expr:
+            case rt.AppC(fnExpr, args):
+                op = self.operator(fnExpr)
+                if op is rmethod.RAIN_NOT and len(args) == 1:
+                    clause = self.predicate(args[0])
+                    return sqa.not_(clause) if clause is not None else None
+                if op in (rmethod.RAIN_AND, rmethod.RAIN_OR) and len(args) == 2:
+                    l, r = self.predicate(args[0]), self.predicate(args[1])
+                    if l is None or r is None:
+                        return None
+                    return sqa.and_(l, r) if op is rmethod.RAIN_AND else sqa.or_(l, r)
+                if op is not None and len(args) == 2:
+                    return self.comparison(op, args[0], args[1])
+            case rt.CompC(expr0, comp, expr1) if comp in COMPARISONS:
+                return self.comparison(comp, expr0, expr1)
+        return None
+
+    def operator(self, fnExpr):
+        match fnExpr:
+            case rt.IdC(id) if id != self.arg:
+                val = self.env.get(id)
+            case rt.ValC(val):
+                pass
+            case _:
+                return None
+        return val.value if type(val) is rt.OpV else None
+
+    def comparison(self, op, expr0, expr1):
+        # One side is a path from the row, the other a value
+        path, val = self.path(expr0), None
+        if path is None:
+            path, val = self.path(expr1), self.value(expr0)
+            op = flipped(op)
+        else:
+            val = self.value(expr1)
+        if path is None or val is None:
+            return None
+
+        if path.t == "entity":
+            # A many-to-one relationship is only equal to none when it's missing
+            if type(val) is not rt.NoneV or op not in (rmethod.RAIN_EQUAL, rmethod.RAIN_NOT_EQUAL):
+                return None
+            exists = path.where(path.attr.has())
+            return sqa.not_(exists) if op is rmethod.RAIN_EQUAL else exists
+
+        col = path.attr
+        if op is rmethod.RAIN_EQUAL or op is rmethod.RAIN_NOT_EQUAL:
+            if type(val) is not rt.NoneV and val.t != path.t:
+                return None
+            clause = col.is_not_distinct_from(val.value) if op is rmethod.RAIN_EQUAL else col.is_distinct_from(val.value)
+            return path.where(clause)
+        if val.t != path.t:
+            # CompC is false for these, the other comparisons raise
+            return sqa.false() if type(op) is str else None
+        compare = COMPARISONS[op] if type(op) is str else ORDERINGS.get(op)
+        if compare is None:
+            return None
+        return path.where(sqa.and_(col.isnot(None), compare(col, val.value)))
+
+    def path(self, expr):
+        attrs = []
+        while type(expr) is rt.DotAccessC and type(expr.id) is rt.IdC:
+            attrs.append(expr.id.id)
+            expr = expr.expr
+        if not attrs or expr != rt.IdC(self.arg):
+            return None
+
+        cls, rels = self.table, []
+        *via, last = reversed(attrs)
+        for attr in via:
+            rel = sqa.inspect(cls).relationships.get(attr)
+            if rel is None or rel.direction is not MANYTOONE:
+                return None
+            rels.append(getattr(cls, attr))
+            cls = rel.mapper.class_
+
+        mapper = sqa.inspect(cls)
+        if last in mapper.column_attrs.keys():
+            t = self.db.type_map[cls.__name__][last].t
+            return Path(rels, getattr(cls, last), t) if t in ("number", "string") else None
+        rel = mapper.relationships.get(last)
+        if rel is not None and rel.direction is MANYTOONE:
+            return Path(rels, getattr(cls, last), "entity")
+        return None
+
+    def value(self, expr):
+        # Arguments that don't depend on the row are evaluated once, here
+        try:
+            val = interp.interp(expr, self.env, self.db, self.ctx)
+        except Exception:
+            return None
+        return val if type(val) in LITERALS else None
+
+def flipped(op):
+    match op:
+        case rmethod.RAIN_GREATER_THAN: return rmethod.RAIN_LESS_THAN
+        case rmethod.RAIN_LESS_THAN: return rmethod.RAIN_GREATER_THAN
+        case rmethod.RAIN_GREATER_TO_OR_EQUAL: return rmethod.RAIN_LESS_TO_OR_EQUAL
+        case rmethod.RAIN_LESS_TO_OR_EQUAL: return rmethod.RAIN_GREATER_TO_OR_EQUAL
+        case ">": return "<"
+        case "<": return ">"
+        case ">=": return "<="
+        case "<=": return ">="
+        case _: return op
+
+def one_arg_closure(fn):
+    return type(fn) is rt.CloV and fn.args is not None and len(fn.args) == 1
+
+def conjuncts(expr, translator):
+    # The operands of nested ands, which can be pushed down separately
+    match expr:
+        case rt.AppC(fnExpr, [l, r]) if translator.operator(fnExpr) is rmethod.RAIN_AND:
+            return conjuncts(l, translator) + conjuncts(r, translator)
+        case _:
+            return [expr]
+
+def filter_clauses(fn, table, db, ctx):
+    # WHERE clauses for the rows fn keeps, and whether they're all of fn.
+    # With only some of them, fn still has to run on the rows they select.
+    if not one_arg_closure(fn):
+        return [], False
+    translator = Translator(fn, table, db, ctx)
+    parts = conjuncts(translator.body, translator)
+    clauses = [clause for clause in map(translator.predicate, parts) if clause is not None]
+    return clauses, len(clauses) == len(parts)
+
+def projection(fn, table, db, ctx):
+    # The column fn reads, if fn only reads a column of its argument
+    if not one_arg_closure(fn):
+        return None
+    translator = Translator(fn, table, db, ctx)
+    path = translator.path(translator.body)
+    if path is None or path.rels or path.t == "entity":
+        return None
+    return path.attr
+
+class RowQuery:
+    # A SELECT and the parameters to run it with in session. Queries built by
+    # follow keep the query they started from and the relationships joined,
+    # as path. Limited ones can't be joined onto, since a join would run
+    # before the LIMIT.
+    __slots__ = ("session", "select", "params", "path", "joinable")
+
+    def __init__(self, session, select, params=None, path=None, joinable=True):
+        self.session = session
+        self.select = select
+        self.params = params or {}
+        self.path = path
+        self.joinable = joinable
+
+    def where(self, *clauses):
+        return RowQuery(self.session, self.select.where(*clauses), self.params)
+
+    def limit(self, n):
+        return RowQuery(self.session, self.select.limit(n), self.params, joinable=False)
+
+    def run(self, select):
+        return self.session.execute(select, self.params)
+
+    def all(self):
+        return self.run(self.select).scalars().all()
+
+def in_rowid_order(select, session, table):
+    # SQLite would otherwise use index order when a WHERE clause can use an
+    # index, or start from another table of a join
+    if session.get_bind().dialect.name == "sqlite":
+        return select.order_by(sqa.literal_column(f"{table.__tablename__}.rowid"))
+    return select
+
+def scan(session, table, col=None):
+    # Rows, or the values of col, in the order TableT.rows reads them
+    return RowQuery(session, in_rowid_order(sqa.select(table if col is None else col), session, table))
+
+def rows(query, db, env):
+    return rt.QuerySeq(query, query.all, db, env)
+
+def column_values(query, col, db, env):
+    return rt.QuerySeq(query, query.all, db, env, column=col)
+
+def attribute_values(session, table, id, db, env):
+    # The values of column or column property id that aren't NULL, for
+    # table.id. Only the column is selected, so no entities are loaded.
+    col = getattr(table, id)
+    return column_values(scan(session, table, col).where(col.isnot(None)), col, db, env)
+
+def row_class(query):
+    # The mapped class query selects, if it selects whole rows of one
+    match query.select.column_descriptions:
+        case [{ "expr": expr, "entity": entity }] if expr is entity and entity is not None:
+            return entity
+    return None
+
+def follow(vals, id, db, env):
+    # vals#id, for rows that haven't been read, as one query that joins along
+    # the many-to-one relationships of the # chain so far and selects column
+    # or relationship id. It reads no rows, so more # steps, .dedup, .length
+    # and the other aggregates go to the database too. None when id is
+    # anything else, or the chain would visit a table twice.
+    query = vals.query
+    if vals.column is not None or not query.joinable:
+        return None
+    base, rels = query.path or (query, ())
+    start = row_class(base)
+    if start is None:
+        return None
+    cls = rels[-1].property.mapper.class_ if rels else start
+
+    mapper = sqa.inspect(cls)
+    if id in mapper.column_attrs.keys():
+        target = column = getattr(cls, id)
+    else:
+        rel = mapper.relationships.get(id)
+        if rel is None or rel.direction is not MANYTOONE:
+            return None
+        rels = (*rels, getattr(cls, id))
+        target, column = rel.mapper.class_, None
+    tables = [sqa.inspect(start).local_table] + [rel.property.mapper.local_table for rel in rels]
+    if len(set(tables)) < len(tables):
+        return None
+
+    # A missing relationship is none, like getattr gives, so the last join is
+    # an outer one when it gives the rows. Through earlier ones, # would raise,
+    # so like filters those rows are skipped.
+    select = base.select
+    for i, rel in enumerate(rels):
+        outer = column is None and i == len(rels) - 1
+        select = select.outerjoin(rel) if outer else select.join(rel)
+    if rels:
+        select = in_rowid_order(select, base.session, start)
+    joined = RowQuery(base.session, select.with_only_columns(target, maintain_column_froms=True), base.params, (base, rels))
+    return rt.QuerySeq(joined, joined.all, db, env, column=column)
+
+# Aggregates over a RowQuery, for QuerySeqs that haven't been read. Only ones
+# that give the same value as reading the rows are asked.
+
+def unloaded(vals):
+    return type(vals) is rt.QuerySeq and vals.loaded is None
+
+def count(query):
+    return query.run(sqa.select(sqa.func.count()).select_from(query.select.subquery())).scalar()
+
+def exists(query):
+    return query.run(sqa.select(query.select.exists())).scalar()
+
+def extreme(query, fn):
+    # fn (max or min) of a column query's values. None when Python's max or
+    # min would see no values or a None, so it runs instead and raises.
+    col = query.select.subquery().c[0]
+    total, present, val = query.run(sqa.select(sqa.func.count(), sqa.func.count(col), fn(col))).one()
+    return val if total > 0 and present == total else None
+
+def distinct(query):
+    col = query.select.subquery().c[0]
+    return query.run(sqa.select(col).distinct()).scalars().all()
+
+def ordered(query):
+    col = query.select.subquery().c[0]
+    return query.run(sqa.select(col).order_by(col)).scalars().all()
+
+@cache
+def collections(cls):
+    # Relationships of cls that hold lists
+    return frozenset(rel.key for rel in sqa.inspect(cls).relationships if rel.uselist)
+
+@cache
+def collection_select(cls, id):
+    # The rows of relationship id of an entity of class cls, with the
+    # entity's join columns as parameters, as (select, {param: attribute}).
+    # Built once per relationship, since with_parent builds a new statement
+    # for every entity. None for relationships through a secondary table or
+    # to the same table, which use with_parent.
+    rel = sqa.inspect(cls).relationships[id]
+    if rel.secondary is not None or rel.mapper.local_table is rel.parent.local_table:
+        return None
+    binds, attrs = {}, {}
+    for i, (local, _) in enumerate(rel.local_remote_pairs):
+        binds[local] = sqa.bindparam(f"parent_{i}")
+        attrs[f"parent_{i}"] = rel.parent.get_property_by_column(local).key
+    where = replacement_traverse(rel.primaryjoin, {}, lambda el: binds.get(el))
+    return sqa.select(rel.mapper.class_).where(where), attrs
+
+def collection(ent, id, db, env):
+    # ent's relationship collection id, which hasn't been loaded yet
+    session = object_session(ent)
+    if session is None:
+        return getattr(ent, id)
+    built = collection_select(type(ent), id)
+    if built is None:
+        attr = getattr(type(ent), id)
+        query = RowQuery(session, sqa.select(attr.property.mapper.class_).where(with_parent(ent, attr)))
+    else:
+        select, attrs = built
+        query = RowQuery(session, select, { param: getattr(ent, key) for param, key in attrs.items() })
+    return rt.QuerySeq(query, lambda: getattr(ent, id), db, env)
+
+def load_options(cls, paths):
+    # Loader options for an entity of class cls, given the relationship paths
+    # a template reads from it (see infer.annotate_types). Each path is loaded
+    # up to its last many-to-one step: many-to-one steps are joined into the
+    # query that loads their parent, collections on the way take one SELECT
+    # IN query each. Reading the rows of a collection then loads nothing per
+    # row. Collections at the end of a path stay unloaded, so aggregates and
+    # # chains over them are still asked of the database.
+    loads = set()
+    for path in paths:
+        rels, c = [], cls
+        for key in path:
+            rel = sqa.inspect(c).relationships[key]
+            rels.append(rel)
+            c = rel.mapper.class_
+        while rels and rels[-1].uselist:
+            rels.pop()
+        if rels:
+            loads.add(tuple(rels))
+
+    options = []
+    for rels in loads:
+        if any(other[:len(rels)] == rels for other in loads if other != rels):
+            continue
+        option = None
+        for rel in reversed(rels):
+            step = (selectinload if rel.uselist else joinedload)(rel.class_attribute)
+            option = step if option is None else step.options(option)
+        options.append(option)
+    return tuple(options)
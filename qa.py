@@ -1,5 +1,13 @@
 import re
-import copy
+from dataclasses import replace
+from types import MappingProxyType
+from functools import partial
+from rain_types import LazyEntV, EvalContext, force_lists
+from interp import interp
+from compiler import compile_expr
+from infer import annotate_types
+import machine
+import pushdown
 
 
 def parse_question_format(q):
@@ -24,21 +32,67 @@ def parse_question_format(q):
     return types
 
 
-def generate_answer_function(parser, lexer, qformat, aformat):
-    _hints = parse_question_format(qformat)
-    
-    # for tok in tokens:
-    #     print('type=%r, value=%r' % (tok.type, tok.value))
+def get_slot_schema(qformat):
+    return { k: t for k, (t, _) in parse_question_format(qformat).items() }
 
-    def wrapped(**kwargs):
-        hints = copy.deepcopy(_hints)
-        tokens = lexer.tokenize(aformat)
-        for k, v in kwargs.items():
-            hint = hints.get(k)
-            if hint is not None:
-                hint[1] = v
-        return parser.parse_with_hints(tokens, hints)
-    
-    return wrapped
 
+# Each engine turns a template's AST into a function of (env, db, ctx).
+# "interp" walks the tree on every evaluation and is kept as the reference.
+# "stack" runs on an explicit continuation stack, so deeply recursive
+# templates don't hit Python's recursion limit.
+ENGINES = {
+    "compiled": compile_expr,
+    "interp": lambda ast: partial(interp, ast),
+    "stack": lambda ast: partial(machine.run, ast),
+}
 
+
+class AnswerTemplate:
+    # An answer format parsed once at registration. Only the slot values
+    # change between questions, so they are bound in evaluate().
+    def __init__(self, source, ast, env, slots, db, engine="compiled", folds=(), fallback="stack"):
+        self.source = source
+        # (before, after) pairs from constant folding, see optimize.fold_constants
+        self.folds = tuple(folds)
+        self.engine = engine
+        self.env = env
+        self.slots = MappingProxyType(dict(slots))
+        slot_env = {
+            k: LazyEntV(db.type_map[db.entity_types[t]], tablename=t) for k, t in slots.items()
+        }
+        # Raises on type errors, so bad templates are caught at registration
+        self.ast, loads = annotate_types(ast, env.extend(slot_env), db)
+        # Each slot entity is loaded with the relationships the template reads from it
+        self.slot_env = MappingProxyType({
+            k: replace(val, options=pushdown.load_options(db.entity_names[val.tablename], loads.get(k, ())))
+            for k, val in slot_env.items()
+        })
+        # Slots are looked up through EvalContext.resolved, so every evaluation shares one scope
+        self.scope = env.extend(self.slot_env)
+        self.run = ENGINES[engine](self.ast)
+        # Engine to start over on when this one runs out of Python stack, or
+        # None to raise the RecursionError
+        self.fallback = fallback if fallback != engine else None
+        self.run_fallback = ENGINES[self.fallback](self.ast) if self.fallback is not None else None
+
+    def context(self, db, **kwargs):
+        hints = { k: [t, kwargs.get(k)] for k, t in self.slots.items() }
+        return EvalContext(hints, session=db.Session())
+
+    def evaluate(self, db, **kwargs):
+        return self.evaluate_in(self.context(db, **kwargs), db)
+
+    def evaluate_in(self, ctx, db):
+        try:
+            try:
+                # Lazy lists are read before returning, so their errors are raised here
+                return force_lists(self.run(self.scope, db, ctx))
+            except RecursionError:
+                if self.run_fallback is None:
+                    raise
+            # Too deep for the Python stack, so start over. Counted, since the
+            # template has then run twice.
+            ctx.counters["recursion fallback"] += 1
+            return force_lists(self.run_fallback(self.scope, db, ctx))
+        finally:
+            ctx.session.close()
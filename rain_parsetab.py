@@ -0,0 +1,516 @@
+# Generated by parsetables.py for RainValueParser2. Do not edit.
+signature = '0ffb16555f9f9c1306a8b95ef221da8b4a560cc617bbdcdc0164dae4029826a2'
+lr_action = {0: {'(': 6,
+     'FLOAT': 10,
+     'FSTRING_START': 13,
+     'ID': 2,
+     'INT': 11,
+     'LET': 8,
+     'STRING': 9,
+     '[': 12},
+ 1: {'#': 15, '$end': 0, '.': 16, 'COMP': 14},
+ 2: {'#': -1,
+     '$end': -1,
+     '(': -1,
+     ')': -1,
+     '.': -1,
+     'COMP': -1,
+     'FLOAT': -1,
+     'FSTRING_END': -1,
+     'FSTRING_MID': -1,
+     'FSTRING_START': -1,
+     'ID': -1,
+     'IN': -1,
+     'INT': -1,
+     'LET': -1,
+     'STRING': -1,
+     '[': -1,
+     ']': -1},
+ 3: {'(': 6,
+     ')': 17,
+     'FLOAT': 10,
+     'FSTRING_START': 13,
+     'ID': 2,
+     'INT': 11,
+     'LET': 8,
+     'STRING': 9,
+     '[': 12},
+ 4: {'(': 6,
+     'FLOAT': 10,
+     'FSTRING_START': 13,
+     'ID': 2,
+     'INT': 11,
+     'LET': 8,
+     'STRING': 9,
+     '[': 12,
+     ']': 19},
+ 5: {')': 21, 'ID': 22},
+ 6: {'(': 6,
+     'FLOAT': 10,
+     'FN': 25,
+     'FSTRING_START': 13,
+     'ID': 2,
+     'IF': 23,
+     'INT': 11,
+     'LET': 8,
+     'STRING': 9,
+     '[': 12},
+ 7: {'(': 6,
+     'FLOAT': 10,
+     'FSTRING_END': 26,
+     'FSTRING_MID': 27,
+     'FSTRING_START': 13,
+     'ID': 2,
+     'INT': 11,
+     'LET': 8,
+     'STRING': 9,
+     '[': 12},
+ 8: {'ID': 29},
+ 9: {'#': -11,
+     '$end': -11,
+     '(': -11,
+     ')': -11,
+     '.': -11,
+     'COMP': -11,
+     'FLOAT': -11,
+     'FSTRING_END': -11,
+     'FSTRING_MID': -11,
+     'FSTRING_START': -11,
+     'ID': -11,
+     'IN': -11,
+     'INT': -11,
+     'LET': -11,
+     'STRING': -11,
+     '[': -11,
+     ']': -11},
+ 10: {'#': -12,
+      '$end': -12,
+      '(': -12,
+      ')': -12,
+      '.': -12,
+      'COMP': -12,
+      'FLOAT': -12,
+      'FSTRING_END': -12,
+      'FSTRING_MID': -12,
+      'FSTRING_START': -12,
+      'ID': -12,
+      'IN': -12,
+      'INT': -12,
+      'LET': -12,
+      'STRING': -12,
+      '[': -12,
+      ']': -12},
+ 11: {'#': -13,
+      '$end': -13,
+      '(': -13,
+      ')': -13,
+      '.': -13,
+      'COMP': -13,
+      'FLOAT': -13,
+      'FSTRING_END': -13,
+      'FSTRING_MID': -13,
+      'FSTRING_START': -13,
+      'ID': -13,
+      'IN': -13,
+      'INT': -13,
+      'LET': -13,
+      'STRING': -13,
+      '[': -13,
+      ']': -13},
+ 12: {'(': -20,
+      'FLOAT': -20,
+      'FSTRING_START': -20,
+      'ID': -20,
+      'INT': -20,
+      'LET': -20,
+      'STRING': -20,
+      '[': -20,
+      ']': -20},
+ 13: {'(': -16,
+      'FLOAT': -16,
+      'FSTRING_END': -16,
+      'FSTRING_MID': -16,
+      'FSTRING_START': -16,
+      'ID': -16,
+      'INT': -16,
+      'LET': -16,
+      'STRING': -16,
+      '[': -16},
+ 14: {'(': 6,
+      'FLOAT': 10,
+      'FSTRING_START': 13,
+      'ID': 2,
+      'INT': 11,
+      'LET': 8,
+      'STRING': 9,
+      '[': 12},
+ 15: {'ID': 31},
+ 16: {'ID': 32},
+ 17: {'#': -3,
+      '$end': -3,
+      '(': -3,
+      ')': -3,
+      '.': -3,
+      'COMP': -3,
+      'FLOAT': -3,
+      'FSTRING_END': -3,
+      'FSTRING_MID': -3,
+      'FSTRING_START': -3,
+      'ID': -3,
+      'IN': -3,
+      'INT': -3,
+      'LET': -3,
+      'STRING': -3,
+      '[': -3,
+      ']': -3},
+ 18: {'#': 15,
+      '(': -21,
+      ')': -21,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': -21,
+      'FSTRING_START': -21,
+      'ID': -21,
+      'INT': -21,
+      'LET': -21,
+      'STRING': -21,
+      '[': -21},
+ 19: {'#': -4,
+      '$end': -4,
+      '(': -4,
+      ')': -4,
+      '.': -4,
+      'COMP': -4,
+      'FLOAT': -4,
+      'FSTRING_END': -4,
+      'FSTRING_MID': -4,
+      'FSTRING_START': -4,
+      'ID': -4,
+      'IN': -4,
+      'INT': -4,
+      'LET': -4,
+      'STRING': -4,
+      '[': -4,
+      ']': -4},
+ 20: {'#': 15,
+      '(': -19,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': -19,
+      'FSTRING_START': -19,
+      'ID': -19,
+      'INT': -19,
+      'LET': -19,
+      'STRING': -19,
+      '[': -19,
+      ']': -19},
+ 21: {'ARROW': 33},
+ 22: {')': -17, 'ID': -17},
+ 23: {'(': 6,
+      'FLOAT': 10,
+      'FSTRING_START': 13,
+      'ID': 2,
+      'INT': 11,
+      'LET': 8,
+      'STRING': 9,
+      '[': 12},
+ 24: {'#': 15,
+      '(': -22,
+      ')': -22,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': -22,
+      'FSTRING_START': -22,
+      'ID': -22,
+      'INT': -22,
+      'LET': -22,
+      'STRING': -22,
+      '[': -22},
+ 25: {'(': 35},
+ 26: {'#': -9,
+      '$end': -9,
+      '(': -9,
+      ')': -9,
+      '.': -9,
+      'COMP': -9,
+      'FLOAT': -9,
+      'FSTRING_END': -9,
+      'FSTRING_MID': -9,
+      'FSTRING_START': -9,
+      'ID': -9,
+      'IN': -9,
+      'INT': -9,
+      'LET': -9,
+      'STRING': -9,
+      '[': -9,
+      ']': -9},
+ 27: {'(': -14,
+      'FLOAT': -14,
+      'FSTRING_END': -14,
+      'FSTRING_MID': -14,
+      'FSTRING_START': -14,
+      'ID': -14,
+      'INT': -14,
+      'LET': -14,
+      'STRING': -14,
+      '[': -14},
+ 28: {'#': 15,
+      '(': -15,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': -15,
+      'FSTRING_END': -15,
+      'FSTRING_MID': -15,
+      'FSTRING_START': -15,
+      'ID': -15,
+      'INT': -15,
+      'LET': -15,
+      'STRING': -15,
+      '[': -15},
+ 29: {'=': 36},
+ 30: {'#': 15,
+      '$end': -2,
+      '(': -2,
+      ')': -2,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': -2,
+      'FSTRING_END': -2,
+      'FSTRING_MID': -2,
+      'FSTRING_START': -2,
+      'ID': -2,
+      'IN': -2,
+      'INT': -2,
+      'LET': -2,
+      'STRING': -2,
+      '[': -2,
+      ']': -2},
+ 31: {'#': -7,
+      '$end': -7,
+      '(': -7,
+      ')': -7,
+      '.': -7,
+      'COMP': -7,
+      'FLOAT': -7,
+      'FSTRING_END': -7,
+      'FSTRING_MID': -7,
+      'FSTRING_START': -7,
+      'ID': -7,
+      'IN': -7,
+      'INT': -7,
+      'LET': -7,
+      'STRING': -7,
+      '[': -7,
+      ']': -7},
+ 32: {'#': -8,
+      '$end': -8,
+      '(': -8,
+      ')': -8,
+      '.': -8,
+      'COMP': -8,
+      'FLOAT': -8,
+      'FSTRING_END': -8,
+      'FSTRING_MID': -8,
+      'FSTRING_START': -8,
+      'ID': -8,
+      'IN': -8,
+      'INT': -8,
+      'LET': -8,
+      'STRING': -8,
+      '[': -8,
+      ']': -8},
+ 33: {'(': 6,
+      'FLOAT': 10,
+      'FSTRING_START': 13,
+      'ID': 2,
+      'INT': 11,
+      'LET': 8,
+      'STRING': 9,
+      '[': 12},
+ 34: {'#': 15,
+      '(': 6,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': 10,
+      'FSTRING_START': 13,
+      'ID': 2,
+      'INT': 11,
+      'LET': 8,
+      'STRING': 9,
+      '[': 12},
+ 35: {')': -18, 'ID': -18},
+ 36: {'(': 6,
+      'FLOAT': 10,
+      'FSTRING_START': 13,
+      'ID': 2,
+      'INT': 11,
+      'LET': 8,
+      'STRING': 9,
+      '[': 12},
+ 37: {'#': 15, ')': 40, '.': 16, 'COMP': 14},
+ 38: {'#': 15,
+      '(': 6,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': 10,
+      'FSTRING_START': 13,
+      'ID': 2,
+      'INT': 11,
+      'LET': 8,
+      'STRING': 9,
+      '[': 12},
+ 39: {'#': 15, '.': 16, 'COMP': 14, 'IN': 42},
+ 40: {'#': -5,
+      '$end': -5,
+      '(': -5,
+      ')': -5,
+      '.': -5,
+      'COMP': -5,
+      'FLOAT': -5,
+      'FSTRING_END': -5,
+      'FSTRING_MID': -5,
+      'FSTRING_START': -5,
+      'ID': -5,
+      'IN': -5,
+      'INT': -5,
+      'LET': -5,
+      'STRING': -5,
+      '[': -5,
+      ']': -5},
+ 41: {'#': 15, ')': 43, '.': 16, 'COMP': 14},
+ 42: {'(': 6,
+      'FLOAT': 10,
+      'FSTRING_START': 13,
+      'ID': 2,
+      'INT': 11,
+      'LET': 8,
+      'STRING': 9,
+      '[': 12},
+ 43: {'#': -6,
+      '$end': -6,
+      '(': -6,
+      ')': -6,
+      '.': -6,
+      'COMP': -6,
+      'FLOAT': -6,
+      'FSTRING_END': -6,
+      'FSTRING_MID': -6,
+      'FSTRING_START': -6,
+      'ID': -6,
+      'IN': -6,
+      'INT': -6,
+      'LET': -6,
+      'STRING': -6,
+      '[': -6,
+      ']': -6},
+ 44: {'#': 15,
+      '$end': -10,
+      '(': -10,
+      ')': -10,
+      '.': 16,
+      'COMP': 14,
+      'FLOAT': -10,
+      'FSTRING_END': -10,
+      'FSTRING_MID': -10,
+      'FSTRING_START': -10,
+      'ID': -10,
+      'IN': -10,
+      'INT': -10,
+      'LET': -10,
+      'STRING': -10,
+      '[': -10,
+      ']': -10}}
+lr_goto = {0: {'expr': 1,
+     'fnargs': 5,
+     'fstring_frag': 7,
+     'partial_app': 3,
+     'partial_arr': 4},
+ 1: {},
+ 2: {},
+ 3: {'expr': 18,
+     'fnargs': 5,
+     'fstring_frag': 7,
+     'partial_app': 3,
+     'partial_arr': 4},
+ 4: {'expr': 20,
+     'fnargs': 5,
+     'fstring_frag': 7,
+     'partial_app': 3,
+     'partial_arr': 4},
+ 5: {},
+ 6: {'expr': 24,
+     'fnargs': 5,
+     'fstring_frag': 7,
+     'partial_app': 3,
+     'partial_arr': 4},
+ 7: {'expr': 28,
+     'fnargs': 5,
+     'fstring_frag': 7,
+     'partial_app': 3,
+     'partial_arr': 4},
+ 8: {},
+ 9: {},
+ 10: {},
+ 11: {},
+ 12: {},
+ 13: {},
+ 14: {'expr': 30,
+      'fnargs': 5,
+      'fstring_frag': 7,
+      'partial_app': 3,
+      'partial_arr': 4},
+ 15: {},
+ 16: {},
+ 17: {},
+ 18: {},
+ 19: {},
+ 20: {},
+ 21: {},
+ 22: {},
+ 23: {'expr': 34,
+      'fnargs': 5,
+      'fstring_frag': 7,
+      'partial_app': 3,
+      'partial_arr': 4},
+ 24: {},
+ 25: {},
+ 26: {},
+ 27: {},
+ 28: {},
+ 29: {},
+ 30: {},
+ 31: {},
+ 32: {},
+ 33: {'expr': 37,
+      'fnargs': 5,
+      'fstring_frag': 7,
+      'partial_app': 3,
+      'partial_arr': 4},
+ 34: {'expr': 38,
+      'fnargs': 5,
+      'fstring_frag': 7,
+      'partial_app': 3,
+      'partial_arr': 4},
+ 35: {},
+ 36: {'expr': 39,
+      'fnargs': 5,
+      'fstring_frag': 7,
+      'partial_app': 3,
+      'partial_arr': 4},
+ 37: {},
+ 38: {'expr': 41,
+      'fnargs': 5,
+      'fstring_frag': 7,
+      'partial_app': 3,
+      'partial_arr': 4},
+ 39: {},
+ 40: {},
+ 41: {},
+ 42: {'expr': 44,
+      'fnargs': 5,
+      'fstring_frag': 7,
+      'partial_app': 3,
+      'partial_arr': 4},
+ 43: {},
+ 44: {}}
+defaulted_states = {}
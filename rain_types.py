@@ -1,7 +1,14 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from collections import Counter
+from collections.abc import Sequence
+from dataclasses import dataclass, field
 from typing import Any
-from copy import deepcopy
+
+try:
+    import numpy as np
+except ImportError:
+    # Numeric lists are aggregated in Python instead
+    np = None
 
 #
 #
@@ -10,150 +17,282 @@ from copy import deepcopy
 #
 
 class ExprC:
-    pass
+    # Nodes and values are slotted, so they carry no per-instance __dict__
+    __slots__ = ()
 
-@dataclass
+@dataclass(slots=True)
 class IdC(ExprC):
     id: str
 
-@dataclass
+@dataclass(slots=True)
 class StringC(ExprC):
     string: str
 
-@dataclass
+@dataclass(slots=True)
 class NumC(ExprC):
     num: int
 
-@dataclass
+@dataclass(slots=True)
 class DotAccessC(ExprC):
     expr: ExprC
     id: IdC
+    # Accessor chosen by infer.annotate_types, taking (val, env, db, ctx)
+    resolved: Any = field(default=None, compare=False, repr=False)
 
-@dataclass
+@dataclass(slots=True)
 class PoundAccessC(ExprC):
     expr: ExprC
     id: IdC
 
-@dataclass
+@dataclass(slots=True)
 class BracketAccessC(ExprC):
     expr0: ExprC
     expr1: ExprC
 
-@dataclass
+@dataclass(slots=True)
 class FnC(ExprC):
     args: list[IdC]
     body: ExprC
-    recurse: bool = False
 
-@dataclass
+@dataclass(slots=True)
+class LetC(ExprC):
+    id: str
+    expr: ExprC
+    body: ExprC
+    # Bind a ThunkV that evaluates expr on first use, see optimize.share_subexprs
+    lazy: bool = False
+
+@dataclass(slots=True)
+class LetRecC(ExprC):
+    id: str
+    fn: FnC
+    body: ExprC
+    # Set by optimize.mark_memoized when fn is pure
+    memo: bool = False
+
+@dataclass(slots=True)
 class AppC(ExprC):
     fn: ExprC
     args: list[ExprC]
 
-@dataclass
+@dataclass(slots=True)
 class CompC(ExprC):
     expr0: ExprC
     comp: str
     expr1: ExprC
 
-@dataclass
+@dataclass(slots=True)
 class ArrC(ExprC):
     vals: list[ExprC]
 
-@dataclass
+@dataclass(slots=True)
 class IfC(ExprC):
     cond: ExprC
     l: ExprC
     r: ExprC
 
-@dataclass
+@dataclass(slots=True)
 class FStringC(ExprC):
     fstring: str
     exprs: list[ExprC]
 
+@dataclass(slots=True)
+class ValC(ExprC):
+    # A value computed at compile time by optimize.fold_constants
+    val: Any
+
+#
+#
+# Environments
+#
+#
+
+_MISSING = object()
+
+class Scope:
+    # An immutable chain of binding frames. Extending a scope links a new frame
+    # to it rather than copying it, so closures capture their scope by reference.
+    __slots__ = ("frame", "parent")
+
+    def __init__(self, frame, parent=None):
+        self.frame = frame
+        self.parent = parent
+
+    def extend(self, frame):
+        return Scope(frame, self)
+
+    def bind(self, id, val):
+        return Scope({id: val}, self)
+
+    def get(self, id, default=None):
+        scope = self
+        while scope is not None:
+            val = scope.frame.get(id, _MISSING)
+            if val is not _MISSING:
+                return val
+            scope = scope.parent
+        return default
+
+    def __getitem__(self, id):
+        val = self.get(id, _MISSING)
+        if val is _MISSING:
+            raise KeyError(id)
+        return val
+
+    def __contains__(self, id):
+        return self.get(id, _MISSING) is not _MISSING
+
+@dataclass(slots=True)
+class EvalContext:
+    # Everything that belongs to one evaluation of a template. Scopes, parsers
+    # and templates are shared between evaluations, so they never hold it.
+    # hints maps each slot to its [entity type, search value]
+    hints: dict
+    # Session that entities and table queries are loaded through
+    session: Any = None
+    # Slot entities already loaded, by slot name
+    resolved: dict = field(default_factory=dict)
+    # Counts of database work done, e.g. ctx.counters["entities"]
+    counters: Counter = field(default_factory=Counter)
+
 #
 #
 # Value types
 #
 #
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class RainVBase:
     value: any
 
     def __str__(self):
         return str(self.value)
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class RainV(RainVBase):
     t: str
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class ObjectV(RainV):
     t: str = "object"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class TableV(RainV):
-    session: Any
     t: str = "table"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class CloV(RainV):
-    env: dict
+    env: Scope
     args: list[IdC] = None
-    recurse: bool = False
+    # Runs the body in the engine that created the closure, if not interp
+    code: Any = None
+    # Results by argument values, for memoized pure functions
+    memo: dict = None
     t: str = "closure"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
+class ThunkV(RainV):
+    # 'value' is code taking (env, db, ctx). Lookups force it, see force.
+    env: Scope
+    cell: list = field(default_factory=list)
+    t: str = "thunk"
+
+@dataclass(frozen=True, kw_only=True, slots=True)
 class OpV(RainV):
     t: str = "op"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class PyCloV(RainV):
-    env: dict
+    env: Scope
     selfValue: RainV = None
     t: str = "py-closure"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class NumberV(RainV):
     t: str = "number"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class StringV(RainV):
     t: str = "string"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class EntV(RainV):
     table: dict
     tablename: str
     t: str = "entity"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class LazyEntV(RainV):
     # 'value' is a dictionary of the entity's columns and types
     tablename: str
+    # Loader options for the relationships the template reads, see pushdown.load_options
+    options: tuple = field(default=(), compare=False)
     t: str = "lazy-ent"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class BoolV(RainV):
     t: str = "bool"
 
     def __str__(self):
         return "true" if self.value is True else "false"
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class NoneV(RainV):
     t: str = "none"
 
     value: None = None
 
-@dataclass(frozen=True, kw_only=True)
+@dataclass(frozen=True, kw_only=True, slots=True)
 class ListV(RainV):
     t: str = "list"
 
     def __str__(self):
         return str([v.value for v in self.value])
 
+#
+#
+# Shared values
+#
+#
+
+# Values are immutable, so common ones are shared instead of reallocated
+TRUE = BoolV(True)
+FALSE = BoolV(False)
+NONE = NoneV()
+
+SMALL_NUMBERS = { n: NumberV(n) for n in range(-5, 257) }
+
+SHORT_STRING_LENGTH = 32
+STRING_CACHE_LIMIT = 4096
+_short_strings = dict()
+
+def bool_value(b):
+    return TRUE if b else FALSE
+
+def number_value(n):
+    # bools and floats equal to a cached int must not be mistaken for it
+    if type(n) is int:
+        val = SMALL_NUMBERS.get(n)
+        if val is not None:
+            return val
+    return NumberV(n)
+
+def string_value(s):
+    if len(s) > SHORT_STRING_LENGTH:
+        return StringV(s)
+    val = _short_strings.get(s)
+    if val is None:
+        val = StringV(s)
+        if len(_short_strings) < STRING_CACHE_LIMIT:
+            _short_strings[s] = val
+    return val
+
+def force(thunk, db, ctx):
+    # Thunks live in per-evaluation frames, so the value is computed at most once per evaluation
+    if not thunk.cell:
+        thunk.cell.append(thunk.value(thunk.env, db, ctx))
+    return thunk.cell[0]
+
 def get_raintype_string_from_val(val):
     if isinstance(val, RainV):
         return "raintype"
@@ -176,19 +315,328 @@ def get_raintype_string_from_val(val):
     else:
         raise Exception(f"Unrecognized raw value {val} of type {type(val)}")
 
+class LazyList(Sequence):
+    # The value of a ListV built from Python values, e.g. a relationship
+    # collection. Elements are wrapped when they are read, so taking the
+    # length or first element of a large list doesn't wrap all of it.
+    __slots__ = ("raw", "wrapped", "db", "env", "array")
+    __match_args__ = ("raw",)
+
+    def __init__(self, raw, db, env):
+        self.raw = raw
+        self.wrapped = None
+        self.db = db
+        self.env = env
+        # Set by as_array
+        self.array = None
+
+    def force(self):
+        if self.wrapped is None:
+            self.wrapped = [rain_wrap(subval, self.db, self.env) for subval in self.raw]
+        return self.wrapped
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, i):
+        if self.wrapped is not None:
+            return self.wrapped[i]
+        if isinstance(i, slice):
+            return LazyList(self.raw[i], self.db, self.env)
+        return rain_wrap(self.raw[i], self.db, self.env)
+
+    def __iter__(self):
+        return iter(self.force())
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.force())
+
+# Kinds of LazySeq stages
+MAP_STAGE = 0
+FILTER_STAGE = 1
+
+class LazySeq(Sequence):
+    # The value of a ListV produced by map, filter or pound access. Each
+    # element of source goes through every stage in one pass, and only when
+    # the list is read and as far as it is read. So a chain like
+    # xs#course#name.first doesn't build intermediate lists or look past the
+    # first element.
+    __slots__ = ("source", "stages", "items", "pending", "array")
+    __match_args__ = ("source",)
+
+    def __init__(self, source, stages):
+        self.source = source
+        self.stages = stages
+        # Elements read so far, and a generator for the rest once reading starts
+        self.items = []
+        self.pending = None
+        # Set by as_array
+        self.array = None
+
+    def then(self, kind, fn):
+        # A sequence applying one more stage. Stages are fused into a single
+        # pass over source until this sequence has been read.
+        if self.pending is None:
+            return LazySeq(self.source, (*self.stages, (kind, fn)))
+        return LazySeq(self, ((kind, fn),))
+
+    def run(self):
+        stages = self.stages
+        for val in self.source:
+            for kind, fn in stages:
+                if kind == MAP_STAGE:
+                    val = fn(val)
+                elif not fn(val):
+                    break
+            else:
+                yield val
+
+    def fill(self, n=None):
+        # Reads until there are n elements, or all of them if n is None
+        items = self.items
+        if self.pending is None:
+            self.pending = self.run()
+        try:
+            if n is None:
+                items.extend(self.pending)
+            elif len(items) < n:
+                for val in self.pending:
+                    items.append(val)
+                    if len(items) >= n:
+                        break
+        except BaseException:
+            # A generator can't resume after raising, so start over on the next read
+            self.items = []
+            self.pending = None
+            raise
+        return items
+
+    def __len__(self):
+        return len(self.fill())
+
+    def __bool__(self):
+        return len(self.fill(1)) > 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            # A prefix only reads as far as it ends
+            if i.stop is not None and i.stop >= 0 and (i.start or 0) >= 0 and (i.step or 1) > 0:
+                return self.fill(i.stop)[i]
+            return self.fill()[i]
+        if i < 0:
+            return self.fill()[i]
+        return self.fill(i + 1)[i]
+
+    def __iter__(self):
+        i = 0
+        while i < len(self.items) or i < len(self.fill(i + 1)):
+            yield self.items[i]
+            i += 1
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.fill())
+
+def add_stage(vals, kind, fn):
+    # The value of a ListV with a map or filter applied to vals
+    if type(vals) is LazySeq:
+        return vals.then(kind, fn)
+    return LazySeq(vals, ((kind, fn),))
+
+class NumArray(Sequence):
+    # The value of a ListV of numbers held in a NumPy array, e.g. a sorted
+    # numeric list. Elements are wrapped as NumberVs when they are read.
+    __slots__ = ("array",)
+    __match_args__ = ("array",)
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return NumArray(self.array[i])
+        return number_value(self.array[i].item())
+
+    def __iter__(self):
+        return (number_value(n) for n in self.array.tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+class QuerySeq(Sequence):
+    # The value of a ListV of rows that haven't been loaded yet: the result of
+    # an SQLAlchemy query, or a relationship collection. Until it's read,
+    # ListT.length, empty, max, min, sort and dedup ask the database about
+    # query instead, see pushdown.py. Reading it loads the rows once through
+    # load, e.g. the relationship attribute, so the ORM sees the same load
+    # as before. column is the queried column when the rows are its values.
+    __slots__ = ("query", "load", "column", "db", "env", "loaded")
+    __match_args__ = ("query",)
+
+    def __init__(self, query, load, db, env, column=None):
+        self.query = query
+        self.load = load
+        self.column = column
+        self.db = db
+        self.env = env
+        self.loaded = None
+
+    def rows(self):
+        if self.loaded is None:
+            self.loaded = LazyList(self.load(), self.db, self.env)
+        return self.loaded
+
+    def __len__(self):
+        return len(self.rows())
+
+    def __getitem__(self, i):
+        return self.rows()[i]
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.rows())
+
+# Types of the values of ListVs
+LIST_TYPES = (list, LazyList, LazySeq, NumArray, QuerySeq)
+
+NOT_NUMERIC = False
+
+def as_array(vals):
+    # The numbers in vals as a NumPy array, or None if vals holds anything
+    # else or NumPy isn't installed. Lazy lists keep the result, so every
+    # aggregate over the same list after the first reuses it.
+    if np is None:
+        return None
+    t = type(vals)
+    if t is NumArray:
+        return vals.array
+    if t is QuerySeq:
+        vals, t = vals.rows(), LazyList
+    if t is not LazyList and t is not LazySeq:
+        # Plain lists are short literals, where converting costs more than it saves
+        return None
+    if vals.array is None:
+        arr = numbers_array(vals)
+        vals.array = NOT_NUMERIC if arr is None else arr
+    return None if vals.array is NOT_NUMERIC else vals.array
+
+def numbers_array(vals):
+    if type(vals) is LazyList and vals.wrapped is None:
+        # Read the Python values without wrapping them
+        nums = vals.raw
+    else:
+        nums = [v.value for v in vals if type(v) is NumberV]
+        if len(nums) != len(vals):
+            return None
+    # Only all ints or all floats, since mixing them would turn the ints into
+    # floats, e.g. the max of [3 2.5] into 3.0. Empty arrays would be floats.
+    if not nums or not (all(type(n) is int for n in nums) or all(type(n) is float for n in nums)):
+        return None
+    arr = np.array(nums)
+    # Ints too large for int64 give an array of objects
+    return arr if arr.dtype.kind in "if" else None
+
+def sum_fits(arr):
+    # Whether arr.sum() is exactly Python's sum: ints that can't wrap around,
+    # which int64 sums do silently. Float sums are pairwise, which rounds
+    # differently from adding left to right.
+    if arr.dtype.kind != "i":
+        return False
+    return len(arr) * max(abs(int(arr.min())), abs(int(arr.max()))) <= np.iinfo(arr.dtype).max
+
+def force_lists(val):
+    # Reads every lazy list in val, e.g. before it leaves an evaluation
+    if type(val) is ListV and type(val.value) in (list, LazySeq):
+        for subval in val.value:
+            force_lists(subval)
+    elif type(val) is ListV and type(val.value) is QuerySeq:
+        # Loaded while the evaluation's session is still open
+        val.value.rows()
+    return val
+
 def rain_wrap(val, db, env, typestring=None):
-    val_type = typestring or get_raintype_string_from_val(val)
-    match val_type:
+    if typestring is None:
+        wrap = _wrappers.get(type(val))
+        if wrap is None:
+            wrap = _wrapper_for(val)
+            _wrappers[type(val)] = wrap
+        return wrap(val, db, env)
+
+    match typestring:
         case "raintype": return val
-        case "string": return StringV(val)
-        case "number": return NumberV(val)
-        case "list": return ListV([rain_wrap(subval, db, env) for subval in val])
-        case "py-closure": return PyCloV(val, env=deepcopy(env))
-        case "none": return NoneV()
-        case "bool": return BoolV(val)
+        case "string": return string_value(val)
+        case "number": return number_value(val)
+        case "list": return wrap_list(val, db, env)
+        case "py-closure": return PyCloV(val, env=env)
+        case "none": return NONE
+        case "bool": return bool_value(val)
         case "object": return ObjectV({k: rain_wrap(v, db, env) for k, v in val.items()})
         case "entity":
             val = val.value if type(val) == EntV else val
             tablename = val._sa_instance_state.class_.__name__
             return EntV(val, table=db.type_map[tablename], tablename=tablename)
-        case _: raise Exception(f"Can't automatically wrap value {val} of type {val_type}")
\ No newline at end of file
+        case _: raise Exception(f"Can't automatically wrap value {val} of type {typestring}")
+
+def wrap_list(val, db, env):
+    return ListV(val if type(val) is LazyList else LazyList(val, db, env))
+
+def wrap_entity_class(cls):
+    tablename = cls.__name__
+    return lambda val, db, env: EntV(val, table=db.type_map[tablename], tablename=tablename)
+
+# How to wrap a value, by its exact type. Whether a value is a Rain value,
+# an entity, a list or a callable only depends on its type, so the first
+# value of each type decides for the rest.
+_wrappers = {
+    str: lambda val, db, env: string_value(val),
+    int: lambda val, db, env: number_value(val),
+    float: lambda val, db, env: number_value(val),
+    bool: lambda val, db, env: bool_value(val),
+    type(None): lambda val, db, env: NONE,
+    list: wrap_list,
+    LazyList: wrap_list,
+    LazySeq: lambda val, db, env: ListV(val),
+    NumArray: lambda val, db, env: ListV(val),
+    QuerySeq: lambda val, db, env: ListV(val)
+}
+
+def _wrapper_for(val):
+    match get_raintype_string_from_val(val):
+        case "raintype":
+            return lambda val, db, env: val
+        case "entity":
+            return wrap_entity_class(type(val))
+        case typestring:
+            return lambda val, db, env: rain_wrap(val, db, env, typestring)
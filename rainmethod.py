@@ -1,98 +1,129 @@
+from functools import cache
+from inspect import signature, Parameter
 from pprint import pprint
+from rain_types import BoolV, ThunkV, force
+
+# Builtins are called positionally as fn(self, env, db, ctx, *args), where
+# args are the Rain values they were applied to and env is the calling
+# environment. Operators have no receiver and are passed None for self.
 
 def rainmethod(paramNames, standalone=False):
+    # Adapts a builtin written as fn(env, db, ctx), which reads its
+    # arguments from env, to the positional convention. Each call extends env
+    # with a frame of the arguments.
     if standalone is False:
         paramNames.insert(0, "self")
 
     def decorator(fn):
-        def wrapped(self, env, db, hints, *args):
+        def wrapped(self, env, db, ctx, *args):
             args = [*args]
             if self is not None:
                 args.insert(0, self)
             zipped_args = dict(zip(paramNames, args))
-            return fn({**env, **zipped_args}, db, hints)
+            return fn(env.extend(zipped_args), db, ctx)
         return wrapped
     return decorator
 
+@cache
+def unbound(method):
+    # A method accessed through its typeclass, e.g. List.at, takes its
+    # receiver as the first argument instead
+    def call(_, env, db, ctx, self, *args):
+        return method(self, env, db, ctx, *args)
+    return call
+
+def lazy(*names):
+    # Declares parameters that are passed as ThunkVs instead of values when
+    # the builtin is applied in a template, so it only evaluates the ones it
+    # needs. Read them with forced.
+    def decorator(fn):
+        params = list(signature(fn).parameters.values())[4:]
+        fixed = tuple(p.name in names for p in params if p.kind is not Parameter.VAR_POSITIONAL)
+        rest = any(p.name in names for p in params if p.kind is Parameter.VAR_POSITIONAL)
+        fn.lazy = (fixed, rest)
+        return fn
+    return decorator
+
+@cache
+def lazy_mask(fn, n):
+    # Which of n arguments fn takes as thunks, or None if it takes values
+    lazy = getattr(fn, "lazy", None)
+    if lazy is None:
+        return None
+    fixed, rest = lazy
+    return tuple(fixed[i] if i < len(fixed) else rest for i in range(n))
+
+def forced(val, db, ctx):
+    # A lazy parameter is still a value when the builtin was applied by
+    # another builtin, e.g. (foldl and true bools)
+    return force(val, db, ctx) if type(val) is ThunkV else val
+
+def bool_operand(op, val):
+    if type(val) is not bool:
+        raise Exception(f"Attempted {op} of non-bool value {val}")
+    return val
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_ADD(env, db, hints):
-    return env["l"].value + env["r"].value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_SUBTRACT(env, db, hints):
-    return env["l"].value - env["r"].value
+def RAIN_ADD(_, env, db, ctx, l, r):
+    return l.value + r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_MULTIPLY(env, db, hints):
-    return env["l"].value * env["r"].value
+def RAIN_SUBTRACT(_, env, db, ctx, l, r):
+    return l.value - r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_DIVIDE(env, db, hints):
-    return env["l"].value / env["r"].value
+def RAIN_MULTIPLY(_, env, db, ctx, l, r):
+    return l.value * r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_MOD(env, db, hints):
-    return env["l"].value % env["r"].value
+def RAIN_DIVIDE(_, env, db, ctx, l, r):
+    return l.value / r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_EXP(env, db, hints):
-    return env["l"].value ** env["r"].value 
+def RAIN_MOD(_, env, db, ctx, l, r):
+    return l.value % r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_EQUAL(env, db, hints):
-    return env["l"].value == env["r"].value
+def RAIN_EXP(_, env, db, ctx, l, r):
+    return l.value ** r.value 
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_NOT_EQUAL(env, db, hints):
-    return env["l"].value != env["r"].value
+def RAIN_EQUAL(_, env, db, ctx, l, r):
+    return l.value == r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_GREATER_THAN(env, db, hints):
-    return env["l"].value > env["r"].value
+def RAIN_NOT_EQUAL(_, env, db, ctx, l, r):
+    return l.value != r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_GREATER_TO_OR_EQUAL(env, db, hints):
-    return env["l"].value >= env["r"].value
+def RAIN_GREATER_THAN(_, env, db, ctx, l, r):
+    return l.value > r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_LESS_THAN(env, db, hints):
-    return env["l"].value < env["r"].value
+def RAIN_GREATER_TO_OR_EQUAL(_, env, db, ctx, l, r):
+    return l.value >= r.value
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_LESS_TO_OR_EQUAL(env, db, hints):
-    return env["l"].value <= env["r"].value
+def RAIN_LESS_THAN(_, env, db, ctx, l, r):
+    return l.value < r.value
 
-@rainmethod(["val"], standalone=True)
-def RAIN_NOT(env, db, hints):
-    match env["val"].value:
+def RAIN_LESS_TO_OR_EQUAL(_, env, db, ctx, l, r):
+    return l.value <= r.value
+
+def RAIN_NOT(_, env, db, ctx, val):
+    match val.value:
         case True: return False
         case False: return True
         case notBool: raise Exception(f"Attempted not of non-bool value {notBool}")
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_AND(env, db, hints):
-    match [env["l"].value, env["r"].value]:
-        case [True, True]:
-            return True
-        case [v1, v2] if type(v1) == type(v2) == bool:
-            return False
-        case [notBool1, notBool2]:
-            raise Exception(f"Attempted and of non-bool value {notBool1} or {notBool2}")
-
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_OR(env, db, hints):
-    match [env["l"].value, env["r"].value]:
-        case [False, False]:
-            return False
-        case [v1, v2] if type(v1) == type(v2) == bool:
-            return True
-        case [notBool1, notBool2]:
-            raise Exception(f"Attempted or of non-bool value {notBool1} or {notBool2}")
-
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_XOR(env, db, hints):
-    match [env["l"].value, env["r"].value]:
+# The right operand of and, or, nand and nor is only evaluated when the left
+# one doesn't decide the result
+@lazy("r")
+def RAIN_AND(_, env, db, ctx, l, r):
+    match l.value:
+        case False: return False
+        case True: return bool_operand("and", forced(r, db, ctx).value)
+        case notBool: raise Exception(f"Attempted and of non-bool value {notBool}")
+
+@lazy("r")
+def RAIN_OR(_, env, db, ctx, l, r):
+    match l.value:
+        case True: return True
+        case False: return bool_operand("or", forced(r, db, ctx).value)
+        case notBool: raise Exception(f"Attempted or of non-bool value {notBool}")
+
+def RAIN_XOR(_, env, db, ctx, l, r):
+    match [l.value, r.value]:
         case [True, True] | [False, False]:
             return False
         case [True, False] | [False, True]:
@@ -100,29 +131,22 @@ def RAIN_XOR(env, db, hints):
         case [notBool1, notBool2]:
             raise Exception(f"Attempted xor of non-bool value {notBool1} or {notBool2}")
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_NAND(env, db, hints):
-    match [env["l"].value, env["r"].value]:
-        case [True, True]:
-            return False
-        case [v1, v2] if type(v1) == type(v2) == bool:
-            return True
-        case [notBool1, notBool2]:
-            raise Exception(f"Attempted nand of non-bool value {notBool1} or {notBool2}")
+@lazy("r")
+def RAIN_NAND(_, env, db, ctx, l, r):
+    match l.value:
+        case False: return True
+        case True: return not bool_operand("nand", forced(r, db, ctx).value)
+        case notBool: raise Exception(f"Attempted nand of non-bool value {notBool}")
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_NOR(env, db, hints):
-    match [env["l"].value, env["r"].value]:
-        case [False, False]:
-            return True
-        case [v1, v2] if type(v1) == type(v2) == bool:
-            return False
-        case [notBool1, notBool2]:
-            raise Exception(f"Attempted nor of non-bool value {notBool1} or {notBool2}")
+@lazy("r")
+def RAIN_NOR(_, env, db, ctx, l, r):
+    match l.value:
+        case True: return False
+        case False: return not bool_operand("nor", forced(r, db, ctx).value)
+        case notBool: raise Exception(f"Attempted nor of non-bool value {notBool}")
 
-@rainmethod(["l", "r"], standalone=True)
-def RAIN_XNOR(env, db, hints):
-    match [env["l"].value, env["r"].value]:
+def RAIN_XNOR(_, env, db, ctx, l, r):
+    match [l.value, r.value]:
         case [True, True] | [False, False]:
             return True
         case [True, False] | [False, True]:
@@ -130,9 +154,8 @@ def RAIN_XNOR(env, db, hints):
         case [notBool1, notBool2]:
             raise Exception(f"Attempted xor of non-bool value {notBool1} or {notBool2}")
 
-@rainmethod(["s"], standalone=True)
-def RAIN_TO_NUM(env, db, hints):
-    sVal = env["s"].value
+def RAIN_TO_NUM(_, env, db, ctx, s):
+    sVal = s.value
     try:
         return int(sVal)
     except ValueError:
@@ -140,9 +163,31 @@ def RAIN_TO_NUM(env, db, hints):
     except:
         return None
 
-@rainmethod(["n"], standalone=True)
-def RAIN_TO_STR(env, db, hints):
+def RAIN_TO_STR(_, env, db, ctx, n):
     try:
-        return str(env["n"].value)
+        return str(n.value)
     except:
-        return None
\ No newline at end of file
+        return None
+
+@lazy("clauses")
+def RAIN_COND(_, env, db, ctx, *clauses):
+    # (cond test0 val0 test1 val1 ... default) evaluates tests in order and
+    # only the value of the first true one, or the default
+    for i in range(0, len(clauses) - 1, 2):
+        match forced(clauses[i], db, ctx):
+            case BoolV(True): return forced(clauses[i + 1], db, ctx)
+            case BoolV(False): continue
+            case notBool: raise Exception("Non-bool cond test", notBool)
+    if len(clauses) % 2 == 1:
+        return forced(clauses[-1], db, ctx)
+    raise Exception("No cond test was true and there is no default")
+
+@lazy("clauses")
+def RAIN_CASE(_, env, db, ctx, key, *clauses):
+    # (case key match0 val0 match1 val1 ... default) compares like eq?
+    for i in range(0, len(clauses) - 1, 2):
+        if forced(clauses[i], db, ctx).value == key.value:
+            return forced(clauses[i + 1], db, ctx)
+    if len(clauses) % 2 == 1:
+        return forced(clauses[-1], db, ctx)
+    raise Exception(f"No case matched {key.value} and there is no default")
@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+import tomllib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+
+@dataclass
+class TemplateEntry:
+    location: str
+    questions: list[str]
+    answer: str
+    memoize: bool = True
+
+
+def load_registry(path):
+    # A registry is a JSON or TOML document with a "templates" list. Each
+    # template has an "answer" (a string, or a list of strings that are
+    # concatenated) and either a "question" or a list of "questions" that
+    # share it. "memoize": false turns off memoization of pure recursive
+    # functions for that template.
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            document = tomllib.load(f)
+        else:
+            document = json.load(f)
+
+    entries = []
+    for i, template in enumerate(document.get("templates", [])):
+        location = f"{path}: template {i}"
+        questions = template.get("questions") or [template.get("question")]
+        answer = template.get("answer")
+        if isinstance(answer, list):
+            answer = "".join(answer)
+        if None in questions or not isinstance(answer, str):
+            raise Exception(f"{location}: templates need a question and an answer")
+        entries.append(TemplateEntry(location, questions, answer, template.get("memoize", True)))
+    return entries
+
+
+_lexer = None
+_parser = None
+
+def parse_answer_source(source):
+    # Runs in worker processes, so each one builds its own lexer and parser
+    global _lexer, _parser
+    if _parser is None:
+        from lex import RainValueLexer2
+        from parse import RainValueParser2
+        _lexer = RainValueLexer2()
+        _parser = RainValueParser2()
+    try:
+        return (source, _parser.parse(_lexer.tokenize(source)), None)
+    except Exception as e:
+        return (source, None, str(e))
+
+
+def parse_answer_sources(sources, workers=None):
+    sources = list(sources)
+    if workers == 1 or len(sources) < 2:
+        results = map(parse_answer_source, sources)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(sources) // (4 * (workers or os.cpu_count() or 1)))
+            results = list(pool.map(parse_answer_source, sources, chunksize=chunksize))
+    return { source: (ast, error) for source, ast, error in results }
+
+
+def check_parsed(entries, parsed):
+    errors = [
+        f"{entry.location} ({entry.questions[0]!r}): {parsed[entry.answer][1]}"
+        for entry in entries if parsed[entry.answer][1] is not None
+    ]
+    if errors:
+        raise Exception("Failed to parse templates:\n" + "\n".join(errors))
+
+
+if __name__=="__main__":
+    # Validate a registry offline, optionally precompiling it into a template cache:
+    # python registry.py templates.json [templates.cache]
+    from parse import GRAMMAR_VERSION, DEFAULT_ENV
+    from template_cache import TemplateCache
+    from optimize import optimize, unparse
+    from rain_types import Scope
+
+    entries = load_registry(sys.argv[1])
+    parsed = parse_answer_sources({ entry.answer for entry in entries })
+    check_parsed(entries, parsed)
+    env = Scope(dict(DEFAULT_ENV))
+    for entry in entries:
+        folds = []
+        optimize(parsed[entry.answer][0], env, folds=folds)
+        for before, after in folds:
+            print(f"{entry.location}: folded {unparse(before)} to {unparse(after)}")
+    if len(sys.argv) > 2:
+        cache = TemplateCache(sys.argv[2], GRAMMAR_VERSION)
+        for source, (ast, _) in parsed.items():
+            cache.put(source, ast)
+        cache.save()
+    print(f"{len(entries)} templates OK")
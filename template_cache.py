@@ -0,0 +1,49 @@
+import hashlib
+import os
+import pickle
+
+
+class TemplateCache:
+    # On-disk store of parsed answer formats. Entries are addressed by a hash
+    # of the answer source and the grammar version, so editing a template or
+    # bumping the grammar simply misses instead of returning a stale tree.
+    def __init__(self, path, grammar_version):
+        self.path = path
+        self.grammar_version = grammar_version
+        self.entries = dict()
+        self.dirty = False
+        self.load()
+
+    def key(self, source):
+        return hashlib.sha256(f"{self.grammar_version}\0{source}".encode()).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                cached = pickle.load(f)
+        except Exception:
+            # Unreadable or written by an incompatible version of rain_types
+            self.dirty = True
+            return
+        if cached.get("grammar_version") != self.grammar_version:
+            self.dirty = True
+            return
+        self.entries = cached["entries"]
+
+    def get(self, source):
+        return self.entries.get(self.key(source))
+
+    def put(self, source, ast):
+        self.entries[self.key(source)] = ast
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"grammar_version": self.grammar_version, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
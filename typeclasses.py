@@ -1,10 +1,15 @@
-from dataclasses import dataclass
+import heapq
+from dataclasses import dataclass, field
+from itertools import takewhile
 from os import stat
+from typing import Any
+import sqlalchemy as sqa
 import rain_types as rt
 from sqlalchemy_utils import get_key_from_column
 from sqlalchemy.orm import MANYTOONE, MANYTOMANY, ONETOMANY
-from rainmethod import rainmethod
+from sqlalchemy.ext.hybrid import hybrid_property
 import interp
+import pushdown
 from pprint import pprint
 
 @dataclass(frozen=True)
@@ -13,105 +18,159 @@ class RainT:
 
 @dataclass(frozen=True, kw_only=True)
 class TableT(RainT):
+    # Types also describe values for infer.py, which fills in the fields below
+    tablename: str = None
     t: str = "table"
 
-    @rainmethod([])
     @staticmethod
-    def rows(env, db, hints):
-        self = env["self"]
-        return self.session().query(self.value).all()
+    def rows(self, env, db, ctx):
+        return ctx.session.query(self.value).all()
 
-    @rainmethod(["func"])
+    # Functions that only read columns are run by the database, see pushdown.py
     @staticmethod
-    def map(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.map(rows, env, db, hints)
+    def map(self, env, db, ctx, func):
+        col = pushdown.projection(func, self.value, db, ctx)
+        if col is not None:
+            ctx.counters["sql map"] += 1
+            return pushdown.column_values(pushdown.scan(ctx.session, self.value, col), col, db, env)
+        ctx.counters["python map"] += 1
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.map(rows, env, db, ctx, func)
 
-    @rainmethod(["func"])
     @staticmethod
-    def filter(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.filter(rows, env, db, hints)
+    def filter(self, env, db, ctx, func):
+        clauses, complete = pushdown.filter_clauses(func, self.value, db, ctx)
+        if complete:
+            ctx.counters["sql filter"] += 1
+            return pushdown.rows(pushdown.scan(ctx.session, self.value).where(*clauses), db, env)
+        if clauses:
+            # The database narrows the rows down, func decides
+            ctx.counters["partial sql filter"] += 1
+            rows = rt.rain_wrap(pushdown.scan(ctx.session, self.value).where(*clauses).all(), db, env)
+        else:
+            ctx.counters["python filter"] += 1
+            rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.filter(rows, env, db, ctx, func)
+
+    @staticmethod
+    def foldl(self, env, db, ctx, func, acc):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.foldl(rows, env, db, ctx, func, acc)
+
+    @staticmethod
+    def rest(self, env, db, ctx):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.rest(rows, env, db, ctx)
 
-    @rainmethod(["func"])
     @staticmethod
-    def map(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.map(rows, env, db, hints)
+    def grammatical_join(self, env, db, ctx, joiner):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.grammatical_join(rows, env, db, ctx, joiner)
+    
+    @staticmethod
+    def gjoin(self, env, db, ctx, joiner):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.grammatical_join(rows, env, db, ctx, joiner)
 
-    @rainmethod(["func", "acc"])
     @staticmethod
-    def foldl(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.foldl(rows, env, db, hints)
+    def length(self, env, db, ctx):
+        ctx.counters["sql count"] += 1
+        return pushdown.count(pushdown.scan(ctx.session, self.value))
 
-    @rainmethod([])
     @staticmethod
-    def rest(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.rest(rows, env, db, hints)
+    def empty(self, env, db, ctx):
+        ctx.counters["sql exists"] += 1
+        return not pushdown.exists(pushdown.scan(ctx.session, self.value))
 
-    @rainmethod(["joiner"])
     @staticmethod
-    def grammatical_join(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.grammatical_join(rows, env, db, hints)
+    def max(self, env, db, ctx):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.max(rows, env, db, ctx)
     
-    @rainmethod(["joiner"])
     @staticmethod
-    def gjoin(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.grammatical_join(rows, env, db, hints)
+    def min(self, env, db, ctx):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.min(rows, env, db, ctx)
 
-    @rainmethod([])
     @staticmethod
-    def length(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.length(rows, env, db, hints)
+    def sort(self, env, db, ctx):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.sort(rows, env, db, ctx)
 
-    @rainmethod([])
     @staticmethod
-    def max(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.max(rows, env, db, hints)
-    
-    @rainmethod([])
+    def max_by(self, env, db, ctx, fn):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.max_by(rows, env, db, ctx, fn)
+
     @staticmethod
-    def min(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.min(rows, env, db, hints)
+    def min_by(self, env, db, ctx, fn):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.min_by(rows, env, db, ctx, fn)
 
-    @rainmethod([])
     @staticmethod
-    def sort(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.sort(rows, env, db, hints)
+    def sort_by(self, env, db, ctx, fn):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.sort_by(rows, env, db, ctx, fn)
 
-    @rainmethod(["fn"])
     @staticmethod
-    def max_by(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.max_by(rows, env, db, hints)
+    def count_where(self, env, db, ctx, fn):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.count_where(rows, env, db, ctx, fn)
 
-    @rainmethod(["fn"])
+    # Selections by a plain column, like (fn (s) -> s.start_time), are left
+    # to the database as ORDER BY ... LIMIT. Rows with no value for the
+    # column are skipped, since their keys couldn't be compared. Ties are
+    # kept in table order, like ListT.top_k's stable selection.
     @staticmethod
-    def min_by(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.min_by(rows, env, db, hints)
+    def top_k(self, env, db, ctx, fn, k):
+        col = plain_column(fn, self.value)
+        if col is not None:
+            query = ctx.session.query(self.value).filter(col.isnot(None)).order_by(col.desc())
+            return pushdown.in_rowid_order(query, ctx.session, self.value).limit(max(k.value, 0)).all()
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.top_k(rows, env, db, ctx, fn, k)
 
-    @rainmethod(["fn"])
     @staticmethod
-    def sort_by(env, db, hints):
-        rows = rt.rain_wrap(TableT.rows(None, env, db, hints), db, env)
-        return ListT.sort_by(rows, env, db, hints)
+    def bottom_k(self, env, db, ctx, fn, k):
+        col = plain_column(fn, self.value)
+        if col is not None:
+            query = ctx.session.query(self.value).filter(col.isnot(None)).order_by(col)
+            return pushdown.in_rowid_order(query, ctx.session, self.value).limit(max(k.value, 0)).all()
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.bottom_k(rows, env, db, ctx, fn, k)
+
+    @staticmethod
+    def take(self, env, db, ctx, n):
+        return pushdown.rows(pushdown.scan(ctx.session, self.value).limit(max(n.value, 0)), db, env)
+
+    @staticmethod
+    def take_while(self, env, db, ctx, fn):
+        rows = rt.rain_wrap(TableT.rows(self, env, db, ctx), db, env)
+        return ListT.take_while(rows, env, db, ctx, fn)
+
+
+def plain_column(fn, table):
+    # The mapped column fn reads, if fn only reads a column of its argument
+    match fn:
+        case rt.CloV(rt.DotAccessC(rt.IdC(id), rt.IdC(attr)), args=[arg]) if id == arg:
+            if attr in sqa.inspect(table).column_attrs.keys():
+                return getattr(table, attr)
+    return None
 
 
 @dataclass(frozen=True, kw_only=True)
 class CloT(RainT):
+    fn: Any = None
+    env: dict = field(default=None, compare=False, hash=False)
     t: str = "closure"
 
 @dataclass(frozen=True, kw_only=True)
 class PyCloT(RainT):
+    # A method of typeclass, bound to a value of type selfT unless it was
+    # accessed through List or String
+    typeclass: Any = None
+    method: str = None
+    selfT: RainT = None
     t: str = "py-closure"
 
 @dataclass(frozen=True, kw_only=True)
@@ -123,67 +182,51 @@ class NumberT(RainT):
 class StringT(RainT):
     t: str = "string"
 
-    @rainmethod(["n"])
     @staticmethod
-    def replicate(env, db, hints):
-        n = env["n"].value
-        selfV = env["self"].value
-        return selfV * n
+    def replicate(self, env, db, ctx, n):
+        return self.value * n.value
 
-    @rainmethod(["substr"])
     @staticmethod
-    def startswith(env, db, hints):
-        substr = env["substr"].value
-        selfV = env["self"].value
-        return selfV.startswith(substr)
+    def startswith(self, env, db, ctx, substr):
+        return self.value.startswith(substr.value)
 
-    @rainmethod(["substr"])
     @staticmethod
-    def endswith(env, db, hints):
-        substr = env["substr"].value
-        selfV = env["self"].value
-        return selfV.endswith(substr)
+    def endswith(self, env, db, ctx, substr):
+        return self.value.endswith(substr.value)
 
-    @rainmethod(["substr"])
     @staticmethod
-    def contains(env, db, hints):
-        substr = env["substr"].value
-        selfV = env["self"].value
-        return selfV.contains(substr)
+    def contains(self, env, db, ctx, substr):
+        return self.value.contains(substr.value)
 
-    @rainmethod([])
     @staticmethod
-    def lower(env, db, hints):
-        return env["self"].value.lower()
+    def lower(self, env, db, ctx):
+        return self.value.lower()
 
-    @rainmethod([])
     @staticmethod
-    def upper(env, db, hints):
-        return env["self"].value.upper()
+    def upper(self, env, db, ctx):
+        return self.value.upper()
 
-    @rainmethod(["bottom", "top"])
     @staticmethod
-    def slice(env, db, hints):
-        selfV = env["self"].value
-        bottom = env["bottom"].value
-        top = env["top"].value
-        return selfV[bottom:top]
+    def slice(self, env, db, ctx, bottom, top):
+        return self.value[bottom.value:top.value]
 
-    @rainmethod([])
     @staticmethod
-    def spell(env, db, hints):
-        selfV = env["self"].value
-        splitted = selfV.split()
+    def spell(self, env, db, ctx):
+        splitted = self.value.split()
         return "; ".join(", ".join(s) for s in splitted)
 
-    @rainmethod(["v"])
     @staticmethod
-    def find(env, db, hints):
-        return env["self"].value.find(env["v"].value)
+    def find(self, env, db, ctx, v):
+        return self.value.find(v.value)
 
 
 @dataclass(frozen=True, kw_only=True)
 class EntT(RainT):
+    # Class name of the entity, the key into Database.type_map
+    tablename: str = None
+    # Relationships followed from a slot to reach the entity, as (slot, key, ...),
+    # for infer.py's loading plan. It doesn't change the type.
+    path: tuple = field(default=None, compare=False, hash=False, repr=False)
     t: str = "entity"
 
 @dataclass(frozen=True, kw_only=True)
@@ -200,6 +243,7 @@ class NoneT(RainT):
 
 @dataclass(frozen=True, kw_only=True)
 class OpT(RainT):
+    op: Any = None
     t: str = "op"
 
 @dataclass(frozen=True, kw_only=True)
@@ -207,142 +251,225 @@ class ListT(RainT):
     subtype: RainT
     t: str = "list"
 
-    @rainmethod(["func"])
+    # map and filter return lazy lists, see rain_types.LazySeq
     @staticmethod
-    def map(env, db, hints):
-        selfV = env["self"].value
-        return [interp.interp_appC(env["func"], [arg], env, db, hints, False) for arg in selfV]
+    def map(self, env, db, ctx, func):
+        return rt.add_stage(self.value, rt.MAP_STAGE, lambda arg: interp.interp_appC(func, [arg], env, db, ctx, False))
     
-    @rainmethod(["func"])
     @staticmethod
-    def filter(env, db, hints):
-        selfV = env["self"].value
-        return [v for v in selfV if interp.interp_appC(env["func"], [v], env, db, hints, False).value is True]
+    def filter(self, env, db, ctx, func):
+        return rt.add_stage(
+            self.value, rt.FILTER_STAGE, lambda v: interp.interp_appC(func, [v], env, db, ctx, False).value is True
+        )
 
-    @rainmethod([])
     @staticmethod
-    def first(env, db, hints):
-        selfV = env["self"].value
-        return selfV[0] if len(selfV) > 0 else None
+    def first(self, env, db, ctx):
+        selfV = self.value
+        return selfV[0] if selfV else None
     
-    @rainmethod([])
     @staticmethod
-    def rest(env, db, hints):
-        selfV = env["self"].value
+    def rest(self, env, db, ctx):
+        selfV = self.value
         return selfV[1:] if len(selfV) > 0 else []
 
-    @rainmethod([])
+    # Lists of rows that haven't been loaded ask the database, see pushdown.py
     @staticmethod
-    def empty(env, db, hints):
-        return len(env["self"].value) == 0
+    def empty(self, env, db, ctx):
+        if pushdown.unloaded(self.value):
+            ctx.counters["sql exists"] += 1
+            return not pushdown.exists(self.value.query)
+        return not self.value
 
-    @rainmethod(["val"])
     @staticmethod
-    def contains(env, db, hints):
-        selfV = env["self"].value
-        searchVal = env["val"].value
-        return searchVal in (wrapped.value for wrapped in selfV)
+    def contains(self, env, db, ctx, val):
+        searchVal = val.value
+        return searchVal in (wrapped.value for wrapped in self.value)
     
-    @rainmethod(["joiner"])
     @staticmethod
-    def grammatical_join(env, db, hints):
-        selfV = env["self"].value
-        joiner = env["joiner"].value
-        match selfV:
+    def grammatical_join(self, env, db, ctx, joiner):
+        joiner = joiner.value
+        match self.value:
             case []: return ""
             case [x]: return x.value
             case [x, y]: return f"{x.value} {joiner} {y.value}"
             case [*body, foot]: return f"{', '.join([str(v.value) for v in body])}, {joiner} {foot.value}"
 
-    @rainmethod(["joiner"])
     @staticmethod
-    def gjoin(env, db, hints):
-        return ListT.grammatical_join(env["self"], env, db, hints)
+    def gjoin(self, env, db, ctx, joiner):
+        return ListT.grammatical_join(self, env, db, ctx, joiner)
 
-    @rainmethod([])
     @staticmethod
-    def length(env, db, hints):
-        return len(env["self"].value)
+    def length(self, env, db, ctx):
+        if pushdown.unloaded(self.value):
+            ctx.counters["sql count"] += 1
+            return pushdown.count(self.value.query)
+        return len(self.value)
     
-    @rainmethod(["fn", "acc"])
-    def foldl(env, db, hints):
-        fn = env["fn"]
-        acc = env["acc"]
-        for subval in env["self"].value:
-            acc = interp.interp_appC(fn, [acc, subval], env, db, hints, False)
-        return acc
-
-    @rainmethod([])
     @staticmethod
-    def dedup(env, db, hints):
-        return list(set(env["self"].value))
+    def foldl(self, env, db, ctx, fn, acc):
+        for subval in self.value:
+            acc = interp.interp_appC(fn, [acc, subval], env, db, ctx, False)
+        return acc
 
-    @rainmethod(["v"])
     @staticmethod
-    def find(env, db, hints):
-        selfV = env["self"].value
-        return [subval.value for subval in selfV].index(env["v"].value)
-
-    @rainmethod([])
-    def max(env, db, hints):
-        return max((item.value for item in env["self"].value))
-
-    @rainmethod([])
-    def min(env, db, hints):
-        return min((item.value for item in env["self"].value))
-
-    @rainmethod([])
-    def sort(env, db, hints):
-        return sorted((item.value for item in env["self"].value))
-
-    @rainmethod(["fn"])
-    def max_by(env, db, hints):
-        fn = env["fn"]
-        selfV = env["self"].value
-
+    def dedup(self, env, db, ctx):
+        if pushdown.unloaded(self.value) and self.value.column is not None:
+            ctx.counters["sql distinct"] += 1
+            return pushdown.distinct(self.value.query)
+        return list(set(self.value))
+
+    # Numeric lists are aggregated with NumPy when it's installed, see
+    # rain_types.as_array
+    @staticmethod
+    def find(self, env, db, ctx, v):
+        arr = rt.as_array(self.value)
+        if arr is not None and type(v) is rt.NumberV:
+            hits = (arr == v.value).nonzero()[0]
+            if len(hits) == 0:
+                raise ValueError(f"{v.value} is not in list")
+            return hits[0].item()
+        return [subval.value for subval in self.value].index(v.value)
+
+    @staticmethod
+    def max(self, env, db, ctx):
+        if pushdown.unloaded(self.value) and self.value.column is not None:
+            val = pushdown.extreme(self.value.query, sqa.func.max)
+            if val is not None:
+                ctx.counters["sql max"] += 1
+                return val
+        arr = rt.as_array(self.value)
+        if arr is not None:
+            return arr.max().item()
+        return max((item.value for item in self.value))
+
+    @staticmethod
+    def min(self, env, db, ctx):
+        if pushdown.unloaded(self.value) and self.value.column is not None:
+            val = pushdown.extreme(self.value.query, sqa.func.min)
+            if val is not None:
+                ctx.counters["sql min"] += 1
+                return val
+        arr = rt.as_array(self.value)
+        if arr is not None:
+            return arr.min().item()
+        return min((item.value for item in self.value))
+
+    @staticmethod
+    def sort(self, env, db, ctx):
+        if pushdown.unloaded(self.value) and self.value.column is not None:
+            ctx.counters["sql sort"] += 1
+            # Already in order, so this only keeps Python's errors for None
+            return sorted(pushdown.ordered(self.value.query))
+        arr = rt.as_array(self.value)
+        if arr is not None:
+            return rt.NumArray(rt.np.sort(arr, kind="stable"))
+        return sorted((item.value for item in self.value))
+
+    @staticmethod
+    def sum(self, env, db, ctx):
+        arr = rt.as_array(self.value)
+        if arr is not None and rt.sum_fits(arr):
+            return arr.sum().item()
+        if arr is not None:
+            return sum(arr.tolist())
+        return sum(item.value for item in self.value)
+
+    @staticmethod
+    def mean(self, env, db, ctx):
+        selfV = self.value
+        if len(selfV) == 0:
+            raise Exception("Attempted mean of an empty list")
+        arr = rt.as_array(selfV)
+        if arr is not None and rt.sum_fits(arr):
+            # Ints are summed exactly and divided once, like Python does
+            return arr.sum().item() / len(arr)
+        if arr is not None:
+            return sum(arr.tolist()) / len(arr)
+        return sum(item.value for item in selfV) / len(selfV)
+
+    @staticmethod
+    def count_where(self, env, db, ctx, fn):
+        return sum(1 for v in self.value if interp.interp_appC(fn, [v], env, db, ctx, False).value is True)
+
+    @staticmethod
+    def argmax(self, env, db, ctx):
+        arr = rt.as_array(self.value)
+        if arr is not None:
+            return arr.argmax().item()
+        values = [item.value for item in self.value]
+        return max(range(len(values)), key=values.__getitem__)
+
+    @staticmethod
+    def argmin(self, env, db, ctx):
+        arr = rt.as_array(self.value)
+        if arr is not None:
+            return arr.argmin().item()
+        values = [item.value for item in self.value]
+        return min(range(len(values)), key=values.__getitem__)
+
+    @staticmethod
+    def max_by(self, env, db, ctx, fn):
         maxVal = None
         maxInterpedVal = None
-        for val in selfV:
-            interpedVal = interp.interp_appC(fn, [val], env, db, hints, False)
+        for val in self.value:
+            interpedVal = interp.interp_appC(fn, [val], env, db, ctx, False)
             if maxInterpedVal is None or interpedVal.value > maxInterpedVal.value:
                 maxInterpedVal = interpedVal
                 maxVal = val
         
         return maxVal.value
     
-    @rainmethod(["fn"])
-    def min_by(env, db, hints):
-        fn = env["fn"]
-        selfV = env["self"].value
-
+    @staticmethod
+    def min_by(self, env, db, ctx, fn):
         minVal = None
         minInterpedVal = None
-        for val in selfV:
-            interpedVal = interp.interp_appC(fn, [val], env, db, hints, False)
+        for val in self.value:
+            interpedVal = interp.interp_appC(fn, [val], env, db, ctx, False)
             if minInterpedVal is None or interpedVal.value < minInterpedVal.value:
                 minInterpedVal = interpedVal
                 minVal = val
         
         return minVal.value
 
-    @rainmethod(["fn"])
-    def sort_by(env, db, hints):
-        fn = env["fn"]
-        selfV = env["self"].value
+    @staticmethod
+    def sort_by(self, env, db, ctx, fn):
+        return sorted(self.value, key=lambda x: interp.interp_appC(fn, [x], env, db, ctx, False).value)
+
+    @staticmethod
+    def at(self, env, db, ctx, i):
+        return self.value[i.value]
+
+    # Partial selections evaluate each key once and keep a heap of k
+    # elements, instead of sorting the whole list
+    @staticmethod
+    def top_k(self, env, db, ctx, fn, k):
+        return heapq.nlargest(k.value, self.value, key=lambda x: interp.interp_appC(fn, [x], env, db, ctx, False).value)
 
-        return sorted(selfV, key=lambda x: interp.interp_appC(fn, [x], env, db, hints, False).value)
+    @staticmethod
+    def bottom_k(self, env, db, ctx, fn, k):
+        return heapq.nsmallest(k.value, self.value, key=lambda x: interp.interp_appC(fn, [x], env, db, ctx, False).value)
 
-    @rainmethod(["i"])
-    def at(env, db, hints):
-        return env["self"].value[env["i"].value]
+    @staticmethod
+    def take(self, env, db, ctx, n):
+        return self.value[:max(n.value, 0)]
+
+    @staticmethod
+    def take_while(self, env, db, ctx, fn):
+        return list(takewhile(lambda x: interp.interp_appC(fn, [x], env, db, ctx, False).value is True, self.value))
 
 
 
 
 @dataclass(frozen=True, kw_only=True)
 class ObjectT(RainT):
+    contents: Any = None
     t: str = "object"
 
+@dataclass(frozen=True, kw_only=True)
+class AnyT(RainT):
+    # Not known until the template is evaluated
+    t: str = "any"
+
 
 _TYPECLASSES = [NumberT, StringT, EntT, ListT, LazyEntT, CloT, BoolT, NoneT, TableT, PyCloT, ObjectT]
 VALUE_MAP = { v.t : v for v in _TYPECLASSES }
@@ -374,16 +501,22 @@ def get_key_type_pairs(inspector):
     pairs = dict()
     # Get types of explicitly-defined columns
     for col in inspector.columns:
-        pairs[get_key_from_column(col, inspector)] = get_raintype_class_from_coltype(col.type)
+        pairs[get_key_from_column(col, inspector)] = get_raintype_class_from_coltype(col.type)()
     
     # Get types of relationships
     for rel in inspector.relationships:
+        ent = EntT(tablename=rel.mapper.class_.__name__)
         if rel.direction == MANYTOMANY or rel.direction == ONETOMANY:
-            t = ListT(subtype=EntT)
+            t = ListT(subtype=ent)
         elif rel.direction == MANYTOONE:
-            t = EntT
+            t = ent
         else:
             raise Exception("Unknown rel.direction")
 
         pairs[rel.key] = t
-    return pairs
\ No newline at end of file
+
+    # Hybrid properties are computed in Python, so their type isn't known
+    for key, descriptor in inspector.all_orm_descriptors.items():
+        if isinstance(descriptor, hybrid_property):
+            pairs[key] = AnyT()
+    return pairs